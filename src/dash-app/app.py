@@ -1,30 +1,72 @@
+import array
+import bisect
 import datetime
-import shutil
+import operator
 
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
+import flask
 import plotly
 import pickle
-import requests
 import time
 import threading
-import os
+import sys
 from datetime import datetime
-from pymodbus.client.sync import ModbusTcpClient
-from dash.dependencies import Input, Output
+from dash.dependencies import Input, Output, State
+from dash.exceptions import PreventUpdate
 from os import path
-
-graph_data = {
-	'battload': [],
-	'time': [],
-	'battvoltage': [],
-	'battwatts': [],
-	'solarwatts': [],
-	'targetbattvoltage': [],
-	'net_production': []
-}
-current_data = {}
+from journal import StateJournal
+
+# The tristar and buffer helpers are shared with the weewx services, so pull them in from the weewx source directory
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..', 'weewx'))
+from ACS758Lib import ACS758Client
+from CollectorLib import CollectorClient, device_key
+from SampleBufferLib import RingBuffer, RunningIntegral, downsample
+from TristarLib import TristarConnection, TristarPoller, charge_state_name
+from history import RollupStore
+from sharedstate import SharedState
+from snapshot import SnapshotFollower, SnapshotPublisher
+from scheduler import Scheduler
+from livefeed import LiveFeed
+
+# The number of one minute graph points to keep, a day's worth by default
+graph_capacity = 2880
+# The graph points, held as epoch seconds and float columns in a fixed size ring buffer so that old points roll off
+# for free
+graph_columns = [('time', 'q'), ('battload', 'f'), ('battvoltage', 'f'), ('battwatts', 'f'), ('solarwatts', 'f'),
+				 ('targetbattvoltage', 'f'), ('net_production', 'f')]
+graph_data = RingBuffer(graph_capacity, graph_columns)
+# Values for graph columns missing from saved data, voltages default to a nominal 24V battery rather than zero
+graph_defaults = {'battvoltage': 23, 'targetbattvoltage': 23}
+# Graph points and stats changes are appended to this journal to survive restarts
+state_journal = StateJournal('monitor_state', graph_columns, defaults=graph_defaults)
+# Bumped every time the graph data changes, so figures built from older data are known to be stale
+graph_version = 0
+# Figures built for each graph from the current graph_version, shared by every browser
+figure_cache = {}
+figure_cache_lock = threading.Lock()
+# Browsers missing more than this many points are sent the whole figure again rather than the missing points
+max_extend_points = 60
+# The most points drawn per trace, about one for every one or two pixels of the kiosk's graph width.  Graphs in the
+# table below can set their own with a 'points' entry.  The full resolution points are kept, this only limits what is
+# sent to the browser.
+graph_point_budget = 500
+# Long range history of the power and energy readings, kept at raw, minute, hour and day resolutions
+history = RollupStore(['load_watts', 'solar_watts', 'batt_watts', 'load_wh', 'solar_wh', 'batt_wh'])
+# How often browsers showing one of the history graphs are sent a fresh figure, in seconds
+history_refresh = 600
+# Energy totals are integrated over the actual reading times.  Readings further apart than this many seconds (a device
+# dropped out) are not integrated across.
+energy_max_gap = 120
+load_energy = RunningIntegral(max_gap=energy_max_gap)
+solar_energy = RunningIntegral(max_gap=energy_max_gap)
+batt_energy = RunningIntegral(max_gap=energy_max_gap)
+# Bumped every time the running stats are updated, so tables built from older stats are known to be stale
+stats_version = 0
+# The live and stats tables built from the current snapshot and stats, shared by every browser
+render_cache = {}
+render_cache_lock = threading.Lock()
 stats_data = {
 	'current_date': datetime.today().date(),
 	'total_load_wh': 0,
@@ -42,10 +84,41 @@ stats_data = {
 	'thirty_days_solar': [0] * 30,
 	'thirty_days_batt_wh': [0] * 30
 }
-# Set this value to the ip of your tristar charge controller
-tristar_addr = '10.0.10.10'
-# Set this value to the base url of your arduino running the acs758 monitoring
-arduino_addr = 'http://10.0.10.31/sensor/'
+# Set these to your tristar charge controllers and the base urls of your arduinos running the acs758 monitoring, as
+# (name, address) pairs.  The first of each is the main device and has no name, any others need a name (the name of
+# their subsection in weewx.conf if following the collector daemon).  The battery voltage and charge state shown are
+# the main charge controller's, the solar power is that of every charge controller together and the battery and load
+# currents are those of every arduino together.
+tristar_devices = [('', '10.0.10.10')]
+arduino_devices = [('', 'http://10.0.10.31/sensor/')]
+# The (name, field prefix, poller) of each charge controller.  Each device's fields are published with its name and an
+# underscore in front, apart from the main device's.  The pollers read the fast changing tristar registers every poll,
+# and the slow moving averages and daily counters less often.
+tristar_pollers = [(name, name + '_' if name else '', TristarPoller(TristarConnection(address, port=502)))
+				   for name, address in tristar_devices]
+# Seconds to wait for an arduino to answer, so a hung arduino cannot hold up its poller
+arduino_timeout = 5
+# The (name, field prefix, client) of each arduino
+arduino_pollers = [(name, name + '_' if name else '', ACS758Client(address, port=None, timeout=arduino_timeout))
+				   for name, address in arduino_devices]
+# Polls every device and updates the stats, graph and history, every job on its own fixed cadence and with a worker of
+# its own so the devices are all polled at once
+scheduler = Scheduler(max_workers=len(tristar_pollers) + len(arduino_pollers) + 3)
+# If the collector daemon is running, set this to its socket (the [DataCollection] socket in weewx.conf) to follow its
+# samples rather than polling the tristar and arduino from here as well
+collector_socket = None
+# When serving from several worker processes (see the README) the poller process shares its state with the workers
+# through this block of shared memory, in slots of these sizes in bytes.  The graph and history slots are sized from
+# graph_capacity and the history graphs' point budgets, see shared_state_slots().
+shared_state_name = 'cabin_monitor_state'
+shared_state_sizes = [('live', 64 * 1024), ('stats', 256 * 1024)]
+# The room allowed for each pickled number of the shared history points, in bytes
+shared_history_value_size = 16
+# The poller process's side of the shared state, None unless running as the poller
+shared_state_writer = None
+# A worker process's side of the shared state, None unless running as a worker
+shared_state_reader = None
+shared_state_lock = threading.Lock()
 
 #
 # Our main html style definitions that are shared
@@ -74,7 +147,7 @@ graphStyle = {
 }
 
 # Initialize the dash app and the main html page
-app = dash.Dash('Cabin Energy Monitor')
+app = dash.Dash('Cabin Energy Monitor', assets_folder=path.join(path.dirname(path.abspath(__file__)), 'assets'))
 app.layout = html.Div(
 	style=divStyle,
 	children=[
@@ -82,7 +155,8 @@ app.layout = html.Div(
 			style=main_div_style,
 			children=[
 				html.Div(id='live-update-text'),
-				html.Div(id='graph-div', children=[dcc.Graph(id='live-update-graph')]),
+				html.Div(id='graph-div', children=[dcc.Graph(id='live-update-graph'),
+												   dcc.Store(id='graph-client-state')]),
 				html.Div(id='stats-div', children=[html.Div(id='live-update-stats')],
 						 style={'display': 'none', 'height': 270}),
 				html.Div(children=[html.Button('Stats/Graph', id='stats-toggle', n_clicks=0,
@@ -93,9 +167,11 @@ app.layout = html.Div(
 									   html.Button('Next Graph >>>', id='next-graph', n_clicks=0,
 												   style={'height': '60px', 'width': '180px'})])],
 						 style={'display': 'flex', 'justify-content': 'space-between'}),
+				# The live values are pushed to the browser as they change, this just redraws the tables now and then in
+				# case the push stream is not getting through
 				dcc.Interval(
 					id='text-interval-component',
-					interval=5000,  # in milliseconds
+					interval=60000,  # in milliseconds
 					n_intervals=0
 				),
 				dcc.Interval(
@@ -108,321 +184,544 @@ app.layout = html.Div(
 
 
 #
-# Fetch the data from the arduino and populate our central dictionary of values
+# Fetch the data from an arduino and publish both channels as one snapshot
 #
-def update_arduino_values():
-	while True:
-		try:
-			resp = requests.get(arduino_addr + '/A0')
-			current_load = 'N/A'
-			resp_dict = {}
-			if resp.status_code == 200:
-				resp_dict = resp.json()
-				current_data["battery_load"] = resp_dict['A0']
-			else:
-				print('Failed to communicate to arduino: ' + str(resp.status_code))
-				current_data["battery_load"] = 0
-		except Exception as e:
-			print('Failed to communicate to arduino: ' + str(e))
-
+def update_arduino_values(prefix, client):
+	values = {}
+	for channel in ('A0', 'A1'):
 		try:
-			resp = requests.get(arduino_addr + '/A1')
-			current_load = 'N/A'
-			resp_dict = {}
-			if resp.status_code == 200:
-				resp_dict = resp.json()
-				current_data["load_amps"] = resp_dict['A1']
-			else:
-				print('Failed to communicate to arduino: ' + str(resp.status_code))
-				current_data["load_amps"] = 0
+			values[prefix + channel] = client.read_channel(channel)[channel]
 		except Exception as e:
 			print('Failed to communicate to arduino: ' + str(e))
-		time.sleep(5)
+	if values:
+		live_data.publish('arduino', values)
 
 
 #
 # Update the running stats with the latest data
 #
 def update_running_stats():
-	global stats_data
-	while True:
-		try:
-			if ('load_amps' in current_data) & ('battery_voltage' in current_data):
-				stats_data['day_load_wh'] += 0.00139 * (current_data['load_amps'] * current_data['battery_voltage'])
-				stats_data['day_solar_wh'] += 0.00139 * current_data['solar_watts']
-				stats_data['day_batt_wh'] += 0.00139 * current_data['battery_load'] * current_data['battery_voltage']
-				stats_data['total_load_wh'] += 0.00139 * (current_data['load_amps'] * current_data['battery_voltage'])
-				stats_data['total_solar_wh'] += 0.00139 * current_data['solar_watts']
-				if stats_data['current_date'] != datetime.today().date():
-					print('Start of new day : ' + str(stats_data['current_date']) + ' ---> ' + str(datetime.today().date()))
-					stats_data['current_date'] = datetime.today().date()
-					stats_data['thirty_days_batt_wh'].pop(0)
-					stats_data['thirty_days_batt_wh'].append(stats_data['day_batt_wh'])
-
-					stats_data['thirty_days_net'].pop(0)
-					stats_data['thirty_days_net'].append(stats_data['day_solar_wh'] - stats_data['day_load_wh'])
-					num_valid_entries = 0.0
-					avg_sum = 0.0
-					for val in stats_data['thirty_days_net']:
-						if val != 0:
-							avg_sum += val
-							num_valid_entries += 1
-					if num_valid_entries > 0:
-						stats_data['avg_net'] = avg_sum / num_valid_entries
-
-					stats_data['thirty_days_load'].pop(0)
-					stats_data['thirty_days_load'].append(stats_data['day_load_wh'])
-					num_valid_entries = 0.0
-					avg_sum = 0.0
-					for val in stats_data['thirty_days_load']:
-						if val != 0:
-							avg_sum += val
-							num_valid_entries += 1
-					if num_valid_entries > 0:
-						stats_data['avg_load'] = avg_sum / num_valid_entries
-
-					stats_data['thirty_days_solar'].pop(0)
-					stats_data['thirty_days_solar'].append(stats_data['day_solar_wh'])
-					num_valid_entries = 0.0
-					avg_sum = 0.0
-					for val in stats_data['thirty_days_solar']:
-						if val != 0:
-							avg_sum += val
-							num_valid_entries += 1
-					if num_valid_entries > 0:
-						stats_data['avg_solar'] = avg_sum / num_valid_entries
-
-					stats_data['total_net'].append(stats_data['day_solar_wh'] - stats_data['day_load_wh'])
-					stats_data['day_load_wh'] = 0
-					stats_data['day_solar_wh'] = 0
-					stats_data['day_batt_wh'] = 0
-
-				stats_data['last_charge_state'] = current_data['charge_state']
-			# persist the latest into a file to handle restarts
-			with open('monitor_stats_data.pkl.tmp', 'wb') as f:
-				pickle.dump(stats_data, f)
-			shutil.move(os.path.join(os.getcwd(), 'monitor_stats_data.pkl.tmp'), os.path.join(os.getcwd(), 'monitor_stats_data.pkl'))
-			time.sleep(5)
-		except Exception as e:
-			print('Failure in updating stats: ' + str(e))
+	global stats_data, stats_version
+	try:
+		snapshot = live_data.current
+		if snapshot.has('load_amps', 'battery_load', 'battery_voltage', 'solar_watts', 'charge_state'):
+			current_data = snapshot.values
+			load_watts = current_data['load_amps'] * current_data['battery_voltage']
+			batt_watts = current_data['battery_load'] * current_data['battery_voltage']
+			# Integrate each reading over the times it was actually taken.  The load and battery currents come from
+			# the arduino and the solar power from the tristar.
+			load_wh = load_energy.add(snapshot.source_times['arduino'], load_watts)
+			batt_wh = batt_energy.add(snapshot.source_times['arduino'], batt_watts)
+			solar_wh = solar_energy.add(snapshot.source_times['tristar'], current_data['solar_watts'])
+			stats_data['day_load_wh'] += load_wh
+			stats_data['day_solar_wh'] += solar_wh
+			stats_data['day_batt_wh'] += batt_wh
+			stats_data['total_load_wh'] += load_wh
+			stats_data['total_solar_wh'] += solar_wh
+			history.add(time.time(), {'load_watts': load_watts,
+									  'solar_watts': current_data['solar_watts'],
+									  'batt_watts': batt_watts,
+									  'load_wh': load_wh,
+									  'solar_wh': solar_wh,
+									  'batt_wh': batt_wh})
+			if stats_data['current_date'] != datetime.today().date():
+				print('Start of new day : ' + str(stats_data['current_date']) + ' ---> ' + str(datetime.today().date()))
+				stats_data['current_date'] = datetime.today().date()
+				stats_data['thirty_days_batt_wh'].pop(0)
+				stats_data['thirty_days_batt_wh'].append(stats_data['day_batt_wh'])
+
+				stats_data['thirty_days_net'].pop(0)
+				stats_data['thirty_days_net'].append(stats_data['day_solar_wh'] - stats_data['day_load_wh'])
+				num_valid_entries = 0.0
+				avg_sum = 0.0
+				for val in stats_data['thirty_days_net']:
+					if val != 0:
+						avg_sum += val
+						num_valid_entries += 1
+				if num_valid_entries > 0:
+					stats_data['avg_net'] = avg_sum / num_valid_entries
+
+				stats_data['thirty_days_load'].pop(0)
+				stats_data['thirty_days_load'].append(stats_data['day_load_wh'])
+				num_valid_entries = 0.0
+				avg_sum = 0.0
+				for val in stats_data['thirty_days_load']:
+					if val != 0:
+						avg_sum += val
+						num_valid_entries += 1
+				if num_valid_entries > 0:
+					stats_data['avg_load'] = avg_sum / num_valid_entries
+
+				stats_data['thirty_days_solar'].pop(0)
+				stats_data['thirty_days_solar'].append(stats_data['day_solar_wh'])
+				num_valid_entries = 0.0
+				avg_sum = 0.0
+				for val in stats_data['thirty_days_solar']:
+					if val != 0:
+						avg_sum += val
+						num_valid_entries += 1
+				if num_valid_entries > 0:
+					stats_data['avg_solar'] = avg_sum / num_valid_entries
+
+				stats_data['total_net'].append(stats_data['day_solar_wh'] - stats_data['day_load_wh'])
+				stats_data['day_load_wh'] = 0
+				stats_data['day_solar_wh'] = 0
+				stats_data['day_batt_wh'] = 0
+
+			stats_data['last_charge_state'] = current_data['charge_state']
+		stats_version += 1
+		# journal whatever changed to handle restarts
+		state_journal.append_stats(stats_data)
+		share_state('stats', stats_data)
+	except Exception as e:
+		print('Failure in updating stats: ' + str(e))
 
 
 #
 # Update the values from the tristar modbus protocol in the values dictionary
 #
-def update_tristar_values():
-	while True:
-		# Connect directly to the modbus interface on the tristar charge controller to get the current information about
-		# the state of the solar array and battery charging
-		modbus_client = ModbusTcpClient(tristar_addr, port=502)
-		try:
-			modbus_client.connect()
-			rr = modbus_client.read_holding_registers(0, 91, unit=1)
-			if rr is None:
-				modbus_client.close()
-				print("Failed to connect and read from tristar modbus")
-			else:
-				voltage_scaling_factor = (float(rr.registers[0]) + (float(rr.registers[1]) / 100))
-				amperage_scaling_factor = (float(rr.registers[2]) + (float(rr.registers[3]) / 100))
-
-				# Voltage Related Statistics
-				current_data["battery_voltage"] = float(rr.registers[24]) * voltage_scaling_factor * 2 ** (-15)
-				current_data["battery_sense_voltage"] = float(rr.registers[26]) * voltage_scaling_factor * 2 ** (-15)
-				current_data["battery_voltage_slow"] = float(rr.registers[38]) * voltage_scaling_factor * 2 ** (-15)
-				current_data["battery_daily_minimum_voltage"] = float(
-					rr.registers[64]) * voltage_scaling_factor * 2 ** (-15)
-				current_data["battery_daily_maximum_voltage"] = float(
-					rr.registers[65]) * voltage_scaling_factor * 2 ** (-15)
-				current_data["target_regulation_voltage"] = float(rr.registers[51]) * voltage_scaling_factor * 2 ** (
-					-15)
-				current_data["array_voltage"] = float(rr.registers[27]) * voltage_scaling_factor * 2 ** (-15)
-				# Current Related Statistics
-				current_data["array_charge_current"] = float(rr.registers[29]) * amperage_scaling_factor * 2 ** (-15)
-				current_data["battery_charge_current"] = float(rr.registers[28]) * amperage_scaling_factor * 2 ** (-15)
-				current_data["battery_charge_current_slow"] = float(rr.registers[39]) * amperage_scaling_factor * 2 ** (
-					-15)
-				# Wattage Related Statistics
-				current_data["input_power"] = float(
-					rr.registers[59]) * voltage_scaling_factor * amperage_scaling_factor * 2 ** (-17)
-				current_data["solar_watts"] = float(
-					rr.registers[58]) * voltage_scaling_factor * amperage_scaling_factor * 2 ** (-17)
-				# Temperature Statistics
-				current_data["heatsink_temperature"] = rr.registers[35]
-				current_data["battery_temperature"] = rr.registers[36]
-				# Misc Statistics
-				charge_states = ["START", "NIGHT_CHECK", "DISCONNECT", "NIGHT", "FAULT", "MPPT", "ABSORPTION", "FLOAT",
-								 "EQUALIZE", "SLAVE"]
-				current_data["charge_state"] = charge_states[rr.registers[50]]
-				current_data["seconds_in_absorption_daily"] = rr.registers[77]
-				current_data["seconds_in_float_daily"] = rr.registers[79]
-				current_data["seconds_in_equalization_daily"] = rr.registers[78]
-				modbus_client.close()
-		except Exception as e:
-			print("Failed to connect to tristar modbus")
-			modbus_client.close()
-		time.sleep(5)
+def update_tristar_values(prefix, poller):
+	# Read from the modbus interface on the tristar charge controller to get the current information about
+	# the state of the solar array and battery charging.  The connection is kept open between polls.
+	try:
+		values = poller.poll()
+		if values is None:
+			print("Failed to connect and read from tristar modbus: " + str(poller.connection.last_error))
+		else:
+			publish_tristar(prefix, values)
+	except Exception as e:
+		print("Failed to process tristar modbus data: " + str(e))
+
+
+def publish_tristar(prefix, values, timestamp=None):
+	values = dict(values)
+	# The dashboard shows the charge state by name
+	if "charge_state" in values:
+		values["charge_state"] = charge_state_name(values["charge_state"])
+	live_data.publish('tristar', dict((prefix + field, value) for field, value in values.items()), timestamp)
+
+
+#
+# Publish a sample received from the collector daemon as if we had polled the device ourselves
+#
+def publish_collected(name, sample):
+	for device_name, prefix, poller in tristar_pollers:
+		if name == device_key('tristar', device_name):
+			publish_tristar(prefix, sample.values, sample.timestamp)
+	for device_name, prefix, client in arduino_pollers:
+		for channel in ('A0', 'A1'):
+			if name == device_key('acs758', device_name) + '_' + channel:
+				live_data.publish('arduino', {prefix + channel: sample.values[channel]}, sample.timestamp)
 
 
 #
-# Update the graph values in the background
+# The totals across the devices that the dashboard shows, from whichever of the devices have reported so far: the
+# controller output of every charge controller as the solar production, and the battery (A0) and load (A1) currents of
+# every arduino
+#
+def combine_devices(values):
+	totals = {}
+	for total, field, pollers in (('solar_watts', 'output_power', tristar_pollers),
+								  ('battery_load', 'A0', arduino_pollers),
+								  ('load_amps', 'A1', arduino_pollers)):
+		readings = [values[prefix + field] for name, prefix, poller in pollers if prefix + field in values]
+		if readings:
+			totals[total] = sum(readings)
+	return totals
+
+
+# The latest readings from the arduinos and tristars, published by the pollers as consistent snapshots along with the
+# totals across them
+live_data = SnapshotPublisher(derive=combine_devices)
+
+
+#
+# Add the latest readings to the graph
 #
 def update_graph_values():
+	global graph_version
+	try:
+		snapshot = live_data.current
+		if not snapshot.has('battery_load', 'battery_voltage', 'solar_watts', 'target_regulation_voltage'):
+			return
+		current_data = snapshot.values
+		# At night the target voltage plummets to zero and screws up the graph, so let's follow the voltage
+		# for night time mode
+		if current_data["target_regulation_voltage"] == 0:
+			target_voltage = current_data["battery_voltage"]
+		else:
+			target_voltage = current_data["target_regulation_voltage"]
+		row = (int(time.time()),
+			   current_data["battery_load"],
+			   current_data["battery_voltage"],
+			   current_data["battery_voltage"] * current_data["battery_load"],
+			   current_data["solar_watts"],
+			   target_voltage,
+			   stats_data['day_solar_wh'] - stats_data['day_load_wh'])
+		# Once we have a days worth of graph data, the ring buffer rotates out the old data
+		graph_data.append(*row)
+		graph_version += 1
+		share_state('graph', graph_data.ordered_columns())
+
+		# journal the new point to handle restarts, folding the journal into a snapshot now and then
+		state_journal.append_graph(row)
+		state_journal.compact(graph_data, stats_data)
+	except Exception as e:
+		print("Failed to update graph statistics: " + str(e))
+
+
+#
+# Write a value to a slot of the shared state, when running as the poller for worker processes
+#
+def share_state(slot, value):
+	if shared_state_writer is None:
+		return
+	try:
+		shared_state_writer.write(slot, value)
+	except Exception as e:
+		print("Failed to share the " + slot + " state: " + str(e))
+
+
+#
+# Share every snapshot the pollers publish, as the poller for worker processes
+#
+def share_live_values():
+	seq = -1
 	while True:
-		try:
-			global graph_data
-			graph_data['time'].append(datetime.now())
-			graph_data['battload'].append(current_data["battery_load"])
-			graph_data['battvoltage'].append(current_data["battery_voltage"])
-			graph_data['battwatts'].append(current_data["battery_voltage"] * current_data["battery_load"])
-			# At night this value plummets to zero and screws up the graph, so let's follow the voltage
-			# for night time mode
-			if current_data["target_regulation_voltage"] == 0:
-				graph_data['targetbattvoltage'].append(current_data["battery_voltage"])
-			else:
-				graph_data['targetbattvoltage'].append(current_data["target_regulation_voltage"])
-			graph_data['solarwatts'].append(current_data["solar_watts"])
-			graph_data['net_production'].append(stats_data['day_solar_wh'] - stats_data['day_load_wh'])
-
-			# If we have more than a days worth of graph data, start rotating out the old data
-			while len(graph_data['time']) > 2880:
-				graph_data['time'].pop(0)
-				graph_data['battload'].pop(0)
-				graph_data['battvoltage'].pop(0)
-				graph_data['battwatts'].pop(0)
-				graph_data['solarwatts'].pop(0)
-				graph_data['targetbattvoltage'].pop(0)
-				graph_data['net_production'].pop(0)
-
-			# persist the latest into a file to handle restarts
-			with open('monitor_data.pkl.tmp', 'wb') as f:
-				pickle.dump(graph_data, f)
-			shutil.move(os.path.join(os.getcwd(), 'monitor_data.pkl.tmp'), os.path.join(os.getcwd(), 'monitor_data.pkl'))
-		except Exception as e:
-			print("Failed to update graph statistics: " + str(e))
-		time.sleep(60)
+		snapshot = live_data.wait_newer(seq)
+		seq = snapshot.seq
+		share_state('live', snapshot)
+
+
+#
+# Share the points of the history graphs, which are only queried now and then as they change slowly.  A history query
+# can return far more rows than a graph draws, so only the points each trace keeps when downsampled to the graph's
+# point budget are shared.
+#
+def share_history():
+	share_state('history', dict((index, shared_history_points(index)) for index, graph in enumerate(graphs)
+								if 'history' in graph))
+
 
+def shared_history_points(current_graph):
+	points = history_points(current_graph)
+	kept = set()
+	for column, name, color in graphs[current_graph]['traces']:
+		kept.update(downsample(points['time'], points[column], point_budget(current_graph)))
+	kept = sorted(kept)
+	return dict((name, [values[i] for i in kept]) for name, values in points.items())
 
+
+#
+# The slots of the shared state and their sizes.  The graph columns are shared whole, so take graph_capacity values of
+# each column's type.  Every trace of a history graph keeps at most its point budget of points, each shared with the
+# time and every trace's value.
+#
+def shared_state_slots():
+	graph_size = 4096 + sum(graph_capacity * array.array(typecode).itemsize for name, typecode in graph_columns)
+	history_size = 4096
+	for index, graph in enumerate(graphs):
+		if 'history' in graph:
+			columns = len(graph['traces']) + 1
+			history_size += point_budget(index) * len(graph['traces']) * columns * shared_history_value_size
+	return shared_state_sizes + [('graph', graph_size), ('history', history_size)]
+
+
+#
+# The latest snapshot of the live readings, from the poller process when running as a worker
+#
+def current_snapshot():
+	if shared_state_reader is not None:
+		return shared_state_reader.read('live', live_data.current)[1]
+	return live_data.current
+
+
+#
+# The running stats along with a version that changes whenever they do, from the poller process when running as a worker
 #
-# Update the live text elements associated with long running statistics
+def current_stats():
+	if shared_state_reader is not None:
+		return shared_state_reader.read('stats', stats_data)
+	return stats_version, stats_data
+
+
+#
+# A version that changes whenever the graph data does
+#
+def current_graph_version():
+	if shared_state_reader is not None:
+		return shared_state_reader.version('graph')
+	return graph_version
+
+
+#
+# The long running statistics table, as rows of (label, cell id) pairs
+#
+stats_cells = [
+	[('Today Usage', 'stats-day-load'), ('Avg Usage', 'stats-avg-load')],
+	[('Today Solar', 'stats-day-solar'), ('Avg Solar', 'stats-avg-solar')],
+	[('Today Net', 'stats-day-net'), ('Avg Net', 'stats-avg-net')],
+	[('Yesterday Net', 'stats-yesterday-net'), ('Yesterday Use', 'stats-yesterday-load')],
+	[('Today Batt Use', 'stats-day-batt'), ('Five Day Net', 'stats-five-day-net')]
+]
+
+
+#
+# The displayed text of each long running statistics cell
+#
+def stats_values(stats):
+	five_day_net = (stats['day_batt_wh']
+					+ stats['thirty_days_batt_wh'][29]
+					+ stats['thirty_days_batt_wh'][28]
+					+ stats['thirty_days_batt_wh'][27]
+					+ stats['thirty_days_batt_wh'][26]) * -1
+	values = {
+		'stats-day-load': stats['day_load_wh'],
+		'stats-avg-load': stats['avg_load'],
+		'stats-day-solar': stats['day_solar_wh'],
+		'stats-avg-solar': stats['avg_solar'],
+		'stats-day-net': stats['day_solar_wh'] - stats['day_load_wh'],
+		'stats-avg-net': stats['avg_net'],
+		'stats-yesterday-net': stats['thirty_days_net'][29],
+		'stats-yesterday-load': stats['thirty_days_load'][29],
+		'stats-day-batt': stats['day_batt_wh'],
+		'stats-five-day-net': five_day_net
+	}
+	return dict((cell_id, '{0:.2f} WH'.format(value)) for cell_id, value in values.items())
+
+
+#
+# Get a table from the render cache, only building it with build if the data it shows has changed, as identified by key,
+# since it was last built
+#
+def cached_render(name, key, build):
+	with render_cache_lock:
+		cached = render_cache.get(name)
+		if cached is None or cached[0] != key:
+			cached = render_cache[name] = (key, build())
+	return cached[1]
+
+
+#
+# Update the live text elements associated with long running statistics.  The cells have ids so the values pushed
+# through the live feed can be patched into them.
 @app.callback(Output('live-update-stats', 'children'), [Input('text-interval-component', 'n_intervals')])
 def update_stats_metrics(n):
+	version, stats = current_stats()
+	return cached_render('stats', version, lambda: build_stats_table(stats))
+
+
+def build_stats_table(stats):
 	table_rows = []
 	td_style = {'border': '1px solid #fca503', 'text-align': 'center', 'font-size': '30px', 'font-family': 'cursive'}
 
-	table_rows.append(html.Tr([
-		html.Td(style=td_style, children="Today Usage"),
-		html.Td(style=td_style, children='{0:.2f} WH'.format(stats_data['day_load_wh'])),
-		html.Td(style=td_style, children="Avg Usage"),
-		html.Td(style=td_style, children='{0:.2f} WH'.format(stats_data['avg_load']))]))
-	table_rows.append(html.Tr([
-		html.Td(style=td_style, children="Today Solar"),
-		html.Td(style=td_style, children='{0:.2f} WH'.format(stats_data['day_solar_wh'])),
-		html.Td(style=td_style, children="Avg Solar"),
-		html.Td(style=td_style, children='{0:.2f} WH'.format(stats_data['avg_solar']))]))
-	table_rows.append(html.Tr([
-		html.Td(style=td_style, children="Today Net"),
-		html.Td(style=td_style, children='{0:.2f} WH'.format(stats_data['day_solar_wh'] - stats_data['day_load_wh'])),
-		html.Td(style=td_style, children="Avg Net"),
-		html.Td(style=td_style, children='{0:.2f} WH'.format(stats_data['avg_net']))]))
-	table_rows.append(html.Tr([
-		html.Td(style=td_style, children="Yesterday Net"),
-		html.Td(style=td_style, children='{0:.2f} WH'.format(stats_data['thirty_days_net'][29])),
-		html.Td(style=td_style, children="Yesterday Use"),
-		html.Td(style=td_style, children='{0:.2f} WH'.format(stats_data['thirty_days_load'][29]))]))
-	table_rows.append(html.Tr([
-		html.Td(style=td_style, children="Today Batt Use"),
-		html.Td(style=td_style, children='{0:.2f} WH'.format(stats_data['day_batt_wh'])),
-		html.Td(style=td_style, children="Five Day Net"),
-		html.Td(style=td_style, children='{0:.2f} WH'.format((stats_data['day_batt_wh']
-															 + stats_data['thirty_days_batt_wh'][29]
-															 + stats_data['thirty_days_batt_wh'][28]
-															 + stats_data['thirty_days_batt_wh'][27]
-															 + stats_data['thirty_days_batt_wh'][26]) * -1))]))
+	values = stats_values(stats)
+	for row in stats_cells:
+		cells = []
+		for label, cell_id in row:
+			cells.append(html.Td(style=td_style, children=label))
+			cells.append(html.Td(id=cell_id, style=td_style, children=values[cell_id]))
+		table_rows.append(html.Tr(cells))
 
 	return html.Table(style={'width': '100%', 'border': '1px solid #fca503'}, children=table_rows)
 
 
+#
+# Format a live value, computed by combine from the given fields of the snapshot if there is more than one, or N/A if
+# any of those fields has not been read yet
+#
+def format_live(snapshot, fmt, fields, combine=None):
+	if not snapshot.has(*fields):
+		return 'N/A'
+	values = [snapshot.values[field] for field in fields]
+	return fmt.format(combine(*values) if combine else values[0])
+
+
+#
+# The live readings table, one (cell id, heading, format, fields, combine) entry per column.  See format_live().
+#
+live_cells = [
+	('live-load-watts', 'Load (W)', '{0:.2f}', ['load_amps', 'battery_voltage'], operator.mul),
+	('live-batt-volts', 'Batt (V)', '{0:.2f}', ['battery_voltage'], None),
+	('live-batt-watts', 'Batt (W)', '{0:0.0f}', ['battery_voltage', 'battery_load'], operator.mul),
+	('live-solar-watts', 'Solar (W)', '{0:0.0f}', ['solar_watts'], None),
+	('live-mode', 'Mode', '{0}', ['charge_state'], None)
+]
+
+
+#
+# The displayed text of each live reading cell for the given snapshot
+#
+def live_values(snapshot):
+	return dict((cell_id, format_live(snapshot, fmt, fields, combine))
+				for cell_id, heading, fmt, fields, combine in live_cells)
+
+
+#
+# Everything the live feed pushes to the browsers for a snapshot
+#
+def live_feed_values(snapshot):
+	values = live_values(snapshot)
+	values.update(stats_values(current_stats()[1]))
+	return values
+
+
+# Pushes the live values to the browsers whenever a poller publishes a snapshot
+live_feed = LiveFeed(live_data, live_feed_values)
+
+
 #
 # update the text elements displaying the live data point
 #
 @app.callback(Output('live-update-text', 'children'), [Input('text-interval-component', 'n_intervals')])
 def update_text_metrics(n):
+	snapshot = current_snapshot()
+	return cached_render('text', snapshot.seq, lambda: build_text_table(snapshot))
+
+
+def build_text_table(snapshot):
 	table_elements = []
 	header_row = []
 	td_style = {'border': '1px solid #fca503', 'text-align': 'center', 'font-size': '30px', 'font-family': 'cursive'}
 
-	# table_elements.append(html.Td(style=td_style, children='{0:.2f} A'.format(battery_load)))
-	# header_row.append(html.Th(style=td_style, children='Batt (A)'))
-	table_elements.append(
-		html.Td(style=td_style, children='{0:.2f}'.format(current_data["load_amps"] * current_data["battery_voltage"])))
-	header_row.append(html.Th(style=td_style, children='Load (W)'))
-	table_elements.append(html.Td(style=td_style, children='{0:.2f}'.format(current_data["battery_voltage"])))
-	header_row.append(html.Th(style=td_style, children='Batt (V)'))
-	table_elements.append(
-		html.Td(style=td_style,
-				children='{0:0.0f}'.format(current_data["battery_voltage"] * current_data["battery_load"])))
-	header_row.append(html.Th(style=td_style, children='Batt (W)'))
-	table_elements.append(html.Td(style=td_style, children='{0:0.0f}'.format(current_data["solar_watts"])))
-	header_row.append(html.Th(style=td_style, children='Solar (W)'))
-	table_elements.append(html.Td(style=td_style, children=current_data["charge_state"]))
-	header_row.append(html.Th(style=td_style, children='Mode'))
+	values = live_values(snapshot)
+	for cell_id, heading, fmt, fields, combine in live_cells:
+		table_elements.append(html.Td(id=cell_id, style=td_style, children=values[cell_id]))
+		header_row.append(html.Th(style=td_style, children=heading))
 
 	return html.Table(style={'width': '100%', 'border': '1px solid #fca503'},
 					  children=[html.Tr(header_row), html.Tr(table_elements)])
 
 
 #
-# Create the actual graph object, also keeping in mind the currently selected graph that we want to display
+# The live feed's event stream.  The browser side is assets/livefeed.js.
+#
+@app.server.route('/live')
+def live_stream():
+	return flask.Response(live_feed.stream(), mimetype='text/event-stream',
+						  headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+#
+# The graphs we can cycle through with the next graph button, in order.  Each graph has a title and the graph columns it
+# plots as (column, trace name, colour) traces, and optionally its own point budget.  History graphs give the number of
+# seconds back they cover as history, and plot the mean of history fields rather than graph columns.
+#
+graphs = [
+	{'title': 'Batt (V)', 'traces': [('battvoltage', 'Batt (V)', '#fca503'),
+									 ('targetbattvoltage', 'Target (V)', '#26f0ec')]},
+	{'title': 'Batt (A)', 'traces': [('battload', 'Load (A)', '#fca503')]},
+	{'title': 'Batt (W)', 'traces': [('battwatts', 'Batt (W)', '#fca503')]},
+	{'title': 'Solar (W)', 'traces': [('solarwatts', 'Solar (W)', '#fca503')]},
+	{'title': 'Batt and Solar (W)', 'traces': [('battwatts', 'Batt (W)', '#eb1717'),
+											   ('solarwatts', 'Solar (W)', '#fbff19')]},
+	{'title': 'Net WH', 'traces': [('net_production', 'Net WH', '#fca503')]},
+	{'title': 'Week (W)', 'history': 7 * 86400, 'traces': [('solar_watts', 'Solar (W)', '#fbff19'),
+														   ('load_watts', 'Load (W)', '#eb1717')]},
+	{'title': 'Month (W)', 'history': 30 * 86400, 'traces': [('solar_watts', 'Solar (W)', '#fbff19'),
+															 ('load_watts', 'Load (W)', '#eb1717')]},
+	{'title': 'Year (W)', 'history': 365 * 86400, 'traces': [('solar_watts', 'Solar (W)', '#fbff19'),
+															 ('load_watts', 'Load (W)', '#eb1717')]}
+]
+
+
+#
+# The time column and the columns plotted by the given graph, all covering the same points in time order.  History
+# graphs are served from whichever history resolution suits their range.  Worker processes take both from the points
+# shared by the poller process.
+#
+def graph_points(current_graph):
+	graph = graphs[current_graph]
+	names = ['time'] + [column for column, name, color in graph['traces']]
+	if shared_state_reader is not None:
+		if 'history' in graph:
+			points = shared_state_reader.read('history', {})[1].get(current_graph, {})
+		else:
+			points = shared_state_reader.read('graph', {})[1]
+		return dict((name, points.get(name, [])) for name in names)
+	if 'history' in graph:
+		return history_points(current_graph)
+	return graph_data.ordered_columns(names)
+
+
+def history_points(current_graph):
+	graph = graphs[current_graph]
+	now = time.time()
+	rows = history.query(now - graph['history'], now, point_budget(current_graph))
+	return dict([('time', rows['time'])] +
+				[(column, rows[column + '_mean']) for column, name, color in graph['traces']])
+
+
+def point_budget(current_graph):
+	return graphs[current_graph].get('points', graph_point_budget)
+
+
+#
+# Create the actual graph object, also keeping in mind the currently selected graph that we want to display.  Each
+# trace is downsampled to the graph's point budget, keeping the points that best preserve its shape.  Returns the
+# figure along with the time of the newest point in it.
 #
 def create_graph(current_graph):
+	points = graph_points(current_graph)
+	times = [datetime.fromtimestamp(t) for t in points['time']]
 	fig = plotly.tools.make_subplots(rows=2, cols=1, vertical_spacing=0.2)
 	fig['layout'] = graphStyle
 	fig['layout']['margin'] = {'l': 30, 'r': 10, 'b': 50, 't': 10}
 	fig['layout']['legend'] = {'x': 0, 'y': 1, 'xanchor': 'right'}
-	if current_graph == 1:
-		fig.append_trace(
-			{'x': graph_data['time'], 'y': graph_data['battload'], 'name': 'Load (A)', 'mode': 'lines',
-			 'type': 'scatter', 'marker': {'color': '#fca503'}, 'line_shape': 'spline'}, 1, 1)
-		fig['layout']['title'] = {'text': 'Batt (A)', 'xanchor': 'center', 'yanchor': 'bottom', 'x': 0.5, 'y': 0,
-								  'font': {'color': '#fca503', 'size': 40}}
-	if current_graph == 0:
-		fig.append_trace(
-			{'x': graph_data['time'], 'y': graph_data['battvoltage'], 'name': 'Batt (V)', 'mode': 'lines',
-			 'type': 'scatter', 'marker': {'color': '#fca503'}, 'line_shape': 'spline'}, 1, 1)
+	for column, name, color in graphs[current_graph]['traces']:
+		values = points[column]
+		kept = downsample(points['time'], values, point_budget(current_graph))
 		fig.append_trace(
-			{'x': graph_data['time'], 'y': graph_data['targetbattvoltage'], 'name': 'Target (V)', 'mode': 'lines',
-			 'type': 'scatter', 'marker': {'color': '#26f0ec'}, 'line_shape': 'spline'}, 1, 1)
-		fig['layout']['title'] = {'text': 'Batt (V)', 'xanchor': 'center', 'yanchor': 'bottom', 'x': 0.5, 'y': 0,
-								  'font': {'color': '#fca503', 'size': 40}}
-	if current_graph == 2:
-		fig.append_trace(
-			{'x': graph_data['time'], 'y': graph_data['battwatts'], 'name': 'Batt (W)', 'mode': 'lines',
-			 'type': 'scatter', 'marker': {'color': '#fca503'}, 'line_shape': 'spline'}, 1, 1)
-		fig['layout']['title'] = {'text': 'Batt (W)', 'xanchor': 'center', 'yanchor': 'bottom', 'x': 0.5, 'y': 0,
-								  'font': {'color': '#fca503', 'size': 40}}
-	if current_graph == 3:
-		fig.append_trace(
-			{'x': graph_data['time'], 'y': graph_data['solarwatts'], 'name': 'Solar (W)', 'mode': 'lines',
-			 'type': 'scatter', 'marker': {'color': '#fca503'}, 'line_shape': 'spline'}, 1, 1)
-		fig['layout']['title'] = {'text': 'Solar (W)', 'xanchor': 'center', 'yanchor': 'bottom', 'x': 0.5, 'y': 0,
-								  'font': {'color': '#fca503', 'size': 40}}
-	if current_graph == 4:
-		fig.append_trace(
-			{'x': graph_data['time'], 'y': graph_data['battwatts'], 'name': 'Batt (W)', 'mode': 'lines',
-			 'type': 'scatter', 'marker': {'color': '#eb1717'}, 'line_shape': 'spline'}, 1, 1)
-		fig.append_trace(
-			{'x': graph_data['time'], 'y': graph_data['solarwatts'], 'name': 'Solar (W)', 'mode': 'lines',
-			 'type': 'scatter', 'marker': {'color': '#fbff19'}, 'line_shape': 'spline'}, 1, 1)
-		fig['layout']['title'] = {'text': 'Batt and Solar (W)', 'xanchor': 'center', 'yanchor': 'bottom', 'x': 0.5,
-								  'y': 0, 'font': {'color': '#fca503', 'size': 40}}
-	if current_graph == 5:
-		fig.append_trace(
-			{'x': graph_data['time'], 'y': graph_data['net_production'], 'name': 'Net WH', 'mode': 'lines',
-			 'type': 'scatter', 'marker': {'color': '#fca503'}, 'line_shape': 'spline'}, 1, 1)
-		fig['layout']['title'] = {'text': 'Net WH', 'xanchor': 'center', 'yanchor': 'bottom', 'x': 0.5, 'y': 0,
-								  'font': {'color': '#fca503', 'size': 40}}
+			{'x': [times[i] for i in kept], 'y': [values[i] for i in kept], 'name': name, 'mode': 'lines',
+			 'type': 'scatter', 'marker': {'color': color}, 'line_shape': 'spline'}, 1, 1)
+	fig['layout']['title'] = {'text': graphs[current_graph]['title'], 'xanchor': 'center', 'yanchor': 'bottom',
+							  'x': 0.5, 'y': 0, 'font': {'color': '#fca503', 'size': 40}}
 
-	return fig
+	return fig, points['time'][-1] if len(points['time']) else 0
+
+
+#
+# Get the figure for the given graph from the cache, only building (and downsampling) it if the graph data has changed
+# since it was last built.  Concurrent requests for the same graph wait for the one build rather than each building their
+# own.  Returns the figure as a dictionary along with the time of the newest point in it.
+#
+def cached_graph(current_graph):
+	version = current_graph_version()
+	with figure_cache_lock:
+		key = (current_graph, version)
+		cached = figure_cache.get(key)
+		if cached is None:
+			# Anything built from older data is never going to be asked for again
+			for stale_key in [k for k in figure_cache if k[1] != version]:
+				del figure_cache[stale_key]
+			figure, last_time = create_graph(current_graph)
+			cached = figure_cache[key] = (figure.to_dict(), last_time)
+	return cached
+
+
+#
+# The points of the given graph newer than last_time, in the form the graph's extendData property takes: the new x and
+# y values for each trace, the trace indices and the number of points to trim the traces to.  shown is the number of
+# points the browser's traces already hold.  Returns None if the browser is far enough behind, or its traces would grow
+# well past the point budget, that it is better to send it the whole (cached, downsampled) figure again.  The time of
+# the newest point and the number of new points are returned alongside.
+#
+def graph_extension(current_graph, last_time, shown):
+	points = graph_points(current_graph)
+	times = points['time']
+	start = bisect.bisect_right(times, last_time)
+	new_points = len(times) - start
+	if new_points > max_extend_points or shown + new_points > point_budget(current_graph) + max_extend_points:
+		return None, last_time, 0
+	if new_points == 0:
+		return {}, last_time, 0
+	new_times = [datetime.fromtimestamp(t) for t in times[start:]]
+	traces = graphs[current_graph]['traces']
+	extension = {
+		'x': [new_times] * len(traces),
+		'y': [points[column][start:].tolist() for column, name, color in traces]
+	}
+	return [extension, list(range(len(traces))), graph_capacity], times[-1], new_points
 
 
 #
@@ -454,69 +753,53 @@ def toggle_graph_div(n_clicks):
 # this case, we want to adjust the graph based on both of these items, so we check to see which input triggered it and
 # update the current graph if staying the same, and adjust the currently selected graph if it is in fact the next graph button
 #
-@app.callback(Output('live-update-graph', 'figure'),
-			  [Input('graph-interval-component', 'n_intervals'), Input('next-graph', 'n_clicks')])
-def update_graph_live(n, n_clicks):
-	current_graph = n_clicks % 6
-
-	return create_graph(current_graph)
-
-
-#
-# Copy the graph data into place, initializing all arrays to the length indicated by the time array.  This protects
-# against empty or missing values from getting things out of whack
-#
-def copy_graph_data(loaded_graph_data):
-	graph_length = 0
-	if 'time' in loaded_graph_data:
-		graph_length = len(loaded_graph_data['time'])
-	if graph_length > 0:
-		graph_data['time'] = [0] * graph_length
-		if 'time' in loaded_graph_data:
-			for i in range(len(loaded_graph_data['time'])):
-				graph_data['time'][i] = loaded_graph_data['time'][i]
-		graph_data['battload'] = [0] * graph_length
-		if 'battload' in loaded_graph_data:
-			for i in range(len(loaded_graph_data['battload'])):
-				graph_data['battload'].append(loaded_graph_data['battload'][i])
-				graph_data['battload'].pop(0)
-		graph_data['battvoltage'] = [23] * graph_length
-		if 'battvoltage' in loaded_graph_data:
-			for i in range(len(loaded_graph_data['battvoltage'])):
-				graph_data['battvoltage'].append(loaded_graph_data['battvoltage'][i])
-				graph_data['battvoltage'].pop(0)
-		graph_data['battwatts'] = [0] * graph_length
-		if 'battwatts' in loaded_graph_data:
-			for i in range(len(loaded_graph_data['battwatts'])):
-				graph_data['battwatts'].append(loaded_graph_data['battwatts'][i])
-				graph_data['battwatts'].pop(0)
-		graph_data['solarwatts'] = [0] * graph_length
-		if 'solarwatts' in loaded_graph_data:
-			for i in range(len(loaded_graph_data['solarwatts'])):
-				graph_data['solarwatts'].append(loaded_graph_data['solarwatts'][i])
-				graph_data['solarwatts'].pop(0)
-		graph_data['targetbattvoltage'] = [23] * graph_length
-		if 'targetbattvoltage' in loaded_graph_data:
-			for i in range(len(loaded_graph_data['targetbattvoltage'])):
-				graph_data['targetbattvoltage'].append(loaded_graph_data['targetbattvoltage'][i])
-				graph_data['targetbattvoltage'].pop(0)
-		graph_data['net_production'] = [0] * graph_length
-		if 'net_production' in loaded_graph_data:
-			for i in range(len(loaded_graph_data['net_production'])):
-				graph_data['net_production'].append(loaded_graph_data['net_production'][i])
-				graph_data['net_production'].pop(0)
+# Each browser keeps the graph it is showing, the time of its newest point and how many points it holds in the
+# graph-client-state store.  The whole figure is only sent when the graph changes (or the page is loaded, or the streamed
+# points have built up), otherwise the interval just streams the points that were added since through extendData.
+# History graphs change slowly, so they are just sent again every history_refresh seconds.
+#
+@app.callback([Output('live-update-graph', 'figure'), Output('live-update-graph', 'extendData'),
+			   Output('graph-client-state', 'data')],
+			  [Input('graph-interval-component', 'n_intervals'), Input('next-graph', 'n_clicks')],
+			  [State('graph-client-state', 'data')])
+def update_graph_live(n, n_clicks, client_state):
+	current_graph = n_clicks % len(graphs)
+	triggered = [t['prop_id'] for t in dash.callback_context.triggered]
+	if client_state is not None and client_state.get('graph') == current_graph and \
+			'next-graph.n_clicks' not in triggered:
+		if 'history' in graphs[current_graph]:
+			if time.time() - client_state.get('refreshed', 0) < history_refresh:
+				raise PreventUpdate
+		else:
+			extension, last_time, new_points = graph_extension(current_graph, client_state['last_time'],
+															   client_state.get('points', 0))
+			if extension == {}:
+				raise PreventUpdate
+			if extension is not None:
+				return dash.no_update, extension, {'graph': current_graph, 'last_time': last_time,
+												   'points': client_state.get('points', 0) + new_points,
+												   'refreshed': client_state.get('refreshed', 0)}
+
+	figure, last_time = cached_graph(current_graph)
+	points = max(len(trace['x']) for trace in figure['data']) if figure['data'] else 0
+	return figure, dash.no_update, {'graph': current_graph, 'last_time': last_time, 'points': points,
+									'refreshed': time.time()}
 
 
-def main():
-	global graph_data
-	global stats_data
+#
+# Load graph and stats data saved as pkl files by earlier versions of the dashboard
+#
+def load_pkl_data():
 	if path.exists('monitor_data.pkl'):
 		try:
 			with open('monitor_data.pkl', 'rb') as f:
 				# Load into a temp variable so if it fails we stick with initial values
 				print("loading graph data from pkl file")
 				loaded_graph_data = pickle.loads(f.read())
-				copy_graph_data(loaded_graph_data)
+				# Older files hold datetime objects for the times rather than epoch seconds
+				loaded_graph_data['time'] = [t.timestamp() if isinstance(t, datetime) else t
+											 for t in loaded_graph_data.get('time', [])]
+				state_journal.load_columns(graph_data, loaded_graph_data)
 		except Exception as e:
 			print("Failed to load monitor pkl data: " + str(e))
 	if path.exists('monitor_stats_data.pkl'):
@@ -529,20 +812,114 @@ def main():
 					stats_data[key] = value
 		except Exception as e:
 			print("Failed to load stats monitor pkl data: " + str(e))
-	arduino_thread = threading.Thread(target=update_arduino_values, args=())
-	arduino_thread.daemon = True
-	arduino_thread.start()
-	tristar_thread = threading.Thread(target=update_tristar_values, args=())
-	tristar_thread.daemon = True
-	tristar_thread.start()
-	stats_thread = threading.Thread(target=update_running_stats, args=())
-	stats_thread.daemon = True
-	stats_thread.start()
-	graph_thread = threading.Thread(target=update_graph_values, args=())
-	graph_thread.daemon = True
-	graph_thread.start()
+
+
+#
+# Load the graph, stats and history data saved by the last run
+#
+def load_state():
+	if state_journal.exists():
+		try:
+			print("loading graph and stats data from the state journal")
+			state_journal.load(graph_data, stats_data)
+		except Exception as e:
+			print("Failed to load the state journal: " + str(e))
+	else:
+		load_pkl_data()
+		# Carry any older pkl data over into the journal's snapshot
+		state_journal.compact(graph_data, stats_data, force=True)
+	try:
+		history.load()
+	except Exception as e:
+		print("Failed to load the history: " + str(e))
+
+
+#
+# Start polling the devices, or following the collector daemon, and updating the stats and graph
+#
+def start_polling():
+	if collector_socket:
+		collector = CollectorClient(collector_socket)
+		collector.subscribe(publish_collected)
+		collector.start()
+	else:
+		for name, prefix, client in arduino_pollers:
+			scheduler.every(device_key('arduino', name), 5,
+							lambda prefix=prefix, client=client: update_arduino_values(prefix, client))
+		for name, prefix, poller in tristar_pollers:
+			scheduler.every(device_key('tristar', name), 5,
+							lambda prefix=prefix, poller=poller: update_tristar_values(prefix, poller))
+	scheduler.every('stats', 5, update_running_stats)
+	scheduler.every('graph', 60, update_graph_values)
+
+
+def main():
+	load_state()
+	start_polling()
+	scheduler.start()
+	live_feed.start()
 	app.run_server(debug=False, host='0.0.0.0')
 
 
+#
+# Run as the poller for worker processes serving the dashboard (see server() below).  This process owns all of the
+# polling and the saved state, and shares the live readings, stats and graph points it keeps with the workers through
+# shared memory.  It does not serve anything itself.
+#
+def poller_main():
+	global shared_state_writer
+	load_state()
+	shared_state_writer = SharedState(shared_state_name, shared_state_slots(), create=True)
+	try:
+		share_state('stats', stats_data)
+		share_state('graph', graph_data.ordered_columns())
+		share_thread = threading.Thread(target=share_live_values, name='ShareLiveValues')
+		share_thread.daemon = True
+		share_thread.start()
+		start_polling()
+		scheduler.every('history', history_refresh, share_history)
+		scheduler.start()
+		print("Sharing the dashboard state as " + shared_state_name)
+		while True:
+			time.sleep(3600)
+	finally:
+		shared_state_writer.close()
+		shared_state_writer.unlink()
+
+
+#
+# Attach a worker process to the poller's shared state, and push the live values it shares to this worker's browsers
+#
+def attach_shared_state():
+	global shared_state_reader, live_feed
+	with shared_state_lock:
+		if shared_state_reader is not None:
+			return
+		try:
+			reader = SharedState(shared_state_name, shared_state_slots())
+		except FileNotFoundError:
+			print("No shared dashboard state to serve, start the poller with: python app.py poller")
+			return
+		shared_state_reader = reader
+		live_feed = LiveFeed(SnapshotFollower(current_snapshot), live_feed_values)
+		live_feed.start()
+
+
+#
+# The WSGI application for worker processes, each of which serves the dashboard from the state shared by the poller
+# process rather than polling anything itself.  Start the poller and then any number of workers, for example:
+#
+#   python app.py poller
+#   gunicorn --workers 4 --threads 8 --bind 0.0.0.0:8050 app:server
+#
+def server(environ, start_response):
+	if shared_state_reader is None:
+		attach_shared_state()
+	return app.server(environ, start_response)
+
+
 if __name__ == '__main__':
-	main()
+	if sys.argv[1:] == ['poller']:
+		poller_main()
+	else:
+		main()
@@ -0,0 +1,44 @@
+//
+// Patches the live values into the page as the server pushes them through the /live event stream, so the tables do not
+// have to be polled for and redrawn.  Each message is a JSON object of cell id to displayed text, holding every cell
+// when the stream starts and only the changed cells after that.
+//
+(function () {
+	if (!window.EventSource) {
+		return;
+	}
+	// Everything received so far, so cells drawn after a message arrived (the page still loading, or the graph and
+	// stats views being switched) can be brought up to date
+	var values = {};
+	var pending = false;
+
+	function apply(cells) {
+		var missing = false;
+		for (var id in cells) {
+			var cell = document.getElementById(id);
+			if (cell) {
+				if (cell.textContent !== cells[id]) {
+					cell.textContent = cells[id];
+				}
+			} else {
+				missing = true;
+			}
+		}
+		if (missing && !pending) {
+			pending = true;
+			setTimeout(function () {
+				pending = false;
+				apply(values);
+			}, 1000);
+		}
+	}
+
+	var source = new EventSource('/live');
+	source.onmessage = function (event) {
+		var cells = JSON.parse(event.data);
+		for (var id in cells) {
+			values[id] = cells[id];
+		}
+		apply(cells);
+	};
+})();
@@ -0,0 +1,205 @@
+import bisect
+import threading
+import time
+from datetime import datetime
+
+from SampleBufferLib import RingBuffer
+from journal import StateJournal
+
+MINUTE = 60
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+
+#
+# The tiers of the history, finest first, as (name, bucket width, retention) in seconds.  The raw tier holds every
+# sample as it was added, each coarser tier holds one row per bucket rolled up from the tier below it.
+#
+DEFAULT_TIERS = [
+	('raw', 5, DAY),
+	('minute', MINUTE, 30 * DAY),
+	('hour', HOUR, 365 * DAY),
+	('day', DAY, 20 * 365 * DAY)
+]
+
+
+#
+# One resolution of the history.  Rows are kept in a ring buffer as the bucket start time, the number of samples in the
+# bucket and then the minimum, maximum and sum of each field.  The bucket currently being filled is held open and only
+# written out once a sample for a later bucket arrives.  Tiers other than raw are journaled to disk.
+#
+class RollupTier(object):
+	def __init__(self, name, width, retention, fields, persist=True):
+		self.name = name
+		self.width = width
+		self.retention = retention
+		self.fields = fields
+		self.columns = [('time', 'q'), ('count', 'I')]
+		for field in fields:
+			self.columns += [(field + '_min', 'f'), (field + '_max', 'f'), (field + '_sum', 'd')]
+		self.buffer = RingBuffer(int(retention // width), self.columns)
+		self.journal = StateJournal('monitor_history_' + name, self.columns) if persist else None
+		self.open = None
+
+	#
+	# bucket()
+	#   The start of the bucket the given time falls in.  Daily buckets start at local midnight, like the day stats.
+	#
+	def bucket(self, timestamp):
+		if self.width >= DAY:
+			return int(time.mktime(datetime.fromtimestamp(timestamp).date().timetuple()))
+		return int(timestamp) - int(timestamp) % self.width
+
+	#
+	# add()
+	#   Roll a row from the tier below into the open bucket.  Returns the previously open bucket's row if this row
+	# started a new bucket, so it can be rolled up into the tier above.
+	#
+	def add(self, row):
+		start = self.bucket(row[0])
+		closed = None
+		if self.open is not None and self.open[0] != start:
+			closed = self.open
+			self.append(closed)
+			self.open = None
+		if self.open is None:
+			self.open = [start] + list(row[1:])
+		else:
+			merge_row(self.open, row)
+		return closed
+
+	def append(self, row):
+		self.buffer.append(*row)
+		if self.journal is not None:
+			self.journal.append_graph(row)
+			self.journal.compact(self.buffer, {})
+
+	def newest(self):
+		times = self.buffer.ordered('time')
+		return times[-1] if len(times) else None
+
+	#
+	# rows()
+	#   The rows with a bucket start between start (inclusive) and end (exclusive), as lists
+	#
+	def rows(self, start, end):
+		columns = self.buffer.ordered_columns()
+		times = columns['time']
+		first = bisect.bisect_left(times, start)
+		last = bisect.bisect_left(times, end)
+		return dict((name, column[first:last].tolist()) for name, column in columns.items())
+
+	def load(self):
+		if self.journal is not None and self.journal.exists():
+			self.journal.load(self.buffer, {})
+
+	def close(self):
+		if self.journal is not None:
+			self.journal.close()
+
+
+#
+# merge_row()
+#   Merge a row's count, minimums, maximums and sums into an open bucket in place
+#
+def merge_row(bucket, row):
+	bucket[1] += row[1]
+	for i in range(2, len(bucket), 3):
+		bucket[i] = min(bucket[i], row[i])
+		bucket[i + 1] = max(bucket[i + 1], row[i + 1])
+		bucket[i + 2] += row[i + 2]
+
+
+#
+# A multi resolution history of a set of fields.  Every sample goes into the raw tier, and each time a bucket of one tier
+# fills up its row is rolled up into the tier above, so the coarse tiers cost nothing to keep up to date.  Each tier
+# only keeps its own retention period, so long ranges are served from hourly or daily rows rather than raw samples.
+#
+class RollupStore(object):
+	def __init__(self, fields, tiers=DEFAULT_TIERS):
+		self.fields = fields
+		self.tiers = [RollupTier(name, width, retention, fields, persist=index > 0)
+					  for index, (name, width, retention) in enumerate(tiers)]
+		self._lock = threading.Lock()
+
+	#
+	# add()
+	#   Add a sample, a dictionary of field to value, taken at the given epoch time
+	#
+	def add(self, timestamp, values):
+		row = [int(timestamp), 1]
+		for field in self.fields:
+			value = values[field]
+			row += [value, value, value]
+		with self._lock:
+			self.tiers[0].append(row)
+			for tier in self.tiers[1:]:
+				row = tier.add(row)
+				if row is None:
+					break
+
+	#
+	# load()
+	#   Load the journaled tiers.  Rows of a tier that never made it into the tier above (the app stopped before the
+	# bucket closed) are rolled up again, and the open buckets are rebuilt from the rows below them.
+	#
+	def load(self):
+		with self._lock:
+			for tier in self.tiers:
+				tier.load()
+			for finer, tier in zip(self.tiers[1:], self.tiers[2:]):
+				newest = tier.newest()
+				columns = finer.buffer.ordered_columns()
+				for i in range(len(columns['time'])):
+					if newest is None or tier.bucket(columns['time'][i]) > newest:
+						tier.add([columns[name][i] for name, typecode in finer.columns])
+
+	#
+	# tier_for()
+	#   The tier to serve a range query from.  That is the coarsest tier still giving at least points rows over the
+	# range, out of the tiers that keep data back to start.
+	#
+	def tier_for(self, start, end, points):
+		# Allow a bucket's slack, so a range of exactly a tier's retention is still served from that tier
+		keeping = [tier for tier in self.tiers if tier.retention + tier.width >= time.time() - start] or \
+			self.tiers[-1:]
+		fine_enough = [tier for tier in keeping if tier.width <= (end - start) / float(points)]
+		return fine_enough[-1] if fine_enough else keeping[0]
+
+	#
+	# query()
+	#   The history between start and end from the tier picked by tier_for(), including the bucket still being filled.
+	# Returns a dictionary holding the bucket start times as time, and for each field the field_min, field_max,
+	# field_mean and field_sum lists.
+	#
+	def query(self, start, end, points=500):
+		tier = self.tier_for(start, end, points)
+		index = self.tiers.index(tier)
+		with self._lock:
+			rows = tier.rows(start, end)
+			# The open buckets of this tier and those below it make up this tier's partial buckets.  They are not always
+			# in the same bucket of this tier: just after a bucket boundary this tier's open bucket is still the one
+			# before it, while the open buckets below have moved on to the new one.
+			partials = {}
+			for open_tier in self.tiers[1:index + 1]:
+				if open_tier.open is None:
+					continue
+				bucket = tier.bucket(open_tier.open[0])
+				if bucket in partials:
+					merge_row(partials[bucket], open_tier.open)
+				else:
+					partials[bucket] = [bucket] + list(open_tier.open[1:])
+		for bucket in sorted(partials):
+			if start <= bucket < end:
+				for (name, typecode), value in zip(tier.columns, partials[bucket]):
+					rows[name].append(value)
+		result = {'time': rows['time']}
+		for field in self.fields:
+			for statistic in ('min', 'max', 'sum'):
+				result[field + '_' + statistic] = rows[field + '_' + statistic]
+			result[field + '_mean'] = [total / count for total, count in zip(rows[field + '_sum'], rows['count'])]
+		return result
+
+	def close(self):
+		with self._lock:
+			for tier in self.tiers:
+				tier.close()
@@ -0,0 +1,271 @@
+import array
+import copy
+import os
+import pickle
+import struct
+import threading
+import time
+import zlib
+
+#
+# On disk format.  Both files start with a four byte magic and a format version, so the layout can change later and
+# files written by older versions are recognised and loaded explicitly.  Files from before the format was versioned
+# (plain pickle snapshots and unchecked journals) are treated as version 0.
+#
+SNAPSHOT_MAGIC = b'OGSS'
+JOURNAL_MAGIC = b'OGSJ'
+FORMAT_VERSION = 1
+FILE_HEADER = struct.Struct('<4sH')
+
+# Journal record kinds
+GRAPH_RECORD = b'G'
+STATS_RECORD = b'S'
+
+# Version 1 journals hold the graph column layout as a block (see below) after the file header.  Their records are a one
+# byte kind, a four byte payload length and the payload's CRC32, followed by the payload.  Version 0 journals had no
+# layout block and no record CRCs.
+RECORD_HEADER = struct.Struct('<cII')
+RECORD_HEADER_V0 = struct.Struct('<cI')
+
+# Version 1 snapshots hold a pickled header (column layout and the stats), then one block per graph column, each block
+# being a length and CRC32 followed by the column's raw array bytes
+BLOCK_HEADER = struct.Struct('<II')
+
+
+#
+# Persists the dashboard's graph points and running stats across restarts without rewriting everything on every tick.
+# Each new graph point and each change to the stats is appended to a compact binary journal, and every so often the
+# whole state is written out as a snapshot and the journal is started over.  Writes go to the OS straight away, but are
+# only fsync'd to the SD card every fsync_interval seconds.
+#
+# Loading reads the snapshot's graph columns straight into typed arrays and replays the journal in bulk, so startup is
+# linear in the amount of data.  Every journal record and snapshot column carries a CRC, so a torn write at the end of
+# the journal after a power cut only loses the damaged records, and a damaged snapshot column only loses that column.
+# Columns that are missing from the files, such as ones added since they were written, are filled from defaults.
+#
+class StateJournal(object):
+	def __init__(self, name, graph_columns, defaults=None, fsync_interval=60.0, compact_interval=86400.0,
+				 compact_bytes=4 * 1024 * 1024):
+		self.snapshot_path = name + '.snapshot'
+		self.journal_path = name + '.journal'
+		self.graph_columns = graph_columns
+		self.graph_names = [column for column, typecode in graph_columns]
+		self.graph_record = struct.Struct('<' + ''.join(typecode for column, typecode in graph_columns))
+		self.defaults = defaults or {}
+		self.fsync_interval = fsync_interval
+		self.compact_interval = compact_interval
+		self.compact_bytes = compact_bytes
+		self._lock = threading.Lock()
+		self._journal = None
+		self._last_fsync = time.time()
+		self._last_compact = time.time()
+		self._stats_written = {}
+
+	def exists(self):
+		return os.path.exists(self.snapshot_path) or os.path.exists(self.journal_path)
+
+	#
+	# load()
+	#   Restore the snapshot and replay the journal on top of it, loading the graph points into graph_buffer and updating
+	# stats_data in place
+	#
+	def load(self, graph_buffer, stats_data):
+		if os.path.exists(self.snapshot_path):
+			with open(self.snapshot_path, 'rb') as f:
+				data = f.read()
+			columns, stats = self._read_snapshot(data)
+			self.load_columns(graph_buffer, columns)
+			stats_data.update(stats)
+		if os.path.exists(self.journal_path):
+			with open(self.journal_path, 'rb') as f:
+				data = f.read()
+			graph_columns, rows, stats_deltas, valid_length = self._read_journal(data)
+			if rows:
+				names = [column for column, typecode in graph_columns]
+				self.load_columns(graph_buffer, dict(zip(names, zip(*rows))))
+			for delta in stats_deltas:
+				stats_data.update(delta)
+			if valid_length < len(data):
+				print("Recovered state journal, dropped %d damaged bytes at the end" % (len(data) - valid_length))
+			if valid_length < len(data) or data[:4] != JOURNAL_MAGIC or \
+					[tuple(c) for c in graph_columns] != [tuple(c) for c in self.graph_columns]:
+				# Start the journal over from the snapshot, so new records never follow damaged, unversioned or
+				# differently laid out ones
+				self.compact(graph_buffer, stats_data, force=True)
+		self._stats_written = copy.deepcopy(stats_data)
+
+	#
+	# load_columns()
+	#   Bulk load graph columns (a dictionary of column name to values, oldest first) into the graph buffer.  Columns the
+	# data does not have are filled with that column's default, and columns the buffer does not have are ignored.
+	#
+	def load_columns(self, graph_buffer, columns):
+		count = len(columns.get(self.graph_names[0], []))
+		if count == 0:
+			return
+		filled = {}
+		for name in self.graph_names:
+			values = columns.get(name)
+			if values is None or len(values) != count:
+				values = [self.defaults.get(name, 0)] * count
+			filled[name] = values
+		graph_buffer.extend(filled)
+
+	#
+	# append_graph()
+	#   Journal one new graph point, given as the values of each graph column in order
+	#
+	def append_graph(self, row):
+		self._append(GRAPH_RECORD, self.graph_record.pack(*row))
+
+	#
+	# append_stats()
+	#   Journal whichever stats values changed since they were last written
+	#
+	def append_stats(self, stats_data):
+		with self._lock:
+			delta = dict((key, value) for key, value in stats_data.items() if self._stats_written.get(key) != value)
+			if not delta:
+				return
+			self._stats_written.update(copy.deepcopy(delta))
+		self._append(STATS_RECORD, pickle.dumps(delta, pickle.HIGHEST_PROTOCOL))
+
+	#
+	# compact()
+	#   Write out a full snapshot and start a fresh journal if forced to, or if the journal has grown large enough or it
+	# has been long enough since the last snapshot
+	#
+	def compact(self, graph_buffer, stats_data, force=False):
+		with self._lock:
+			journal_size = self._journal.tell() if self._journal is not None else 0
+			if not force and journal_size < self.compact_bytes and \
+					time.time() - self._last_compact < self.compact_interval:
+				return
+			tmp_path = self.snapshot_path + '.tmp'
+			with open(tmp_path, 'wb') as f:
+				f.write(self._snapshot_bytes(graph_buffer, stats_data))
+				f.flush()
+				os.fsync(f.fileno())
+			os.replace(tmp_path, self.snapshot_path)
+			# Everything journaled so far is in the snapshot now
+			if self._journal is not None:
+				self._journal.close()
+			self._journal = open(self.journal_path, 'wb')
+			self._journal.write(self._journal_header())
+			self._journal.flush()
+			self._stats_written = copy.deepcopy(stats_data)
+			self._last_compact = time.time()
+
+	def close(self):
+		with self._lock:
+			if self._journal is not None:
+				self._journal.flush()
+				os.fsync(self._journal.fileno())
+				self._journal.close()
+				self._journal = None
+
+	def _append(self, kind, payload):
+		with self._lock:
+			if self._journal is None:
+				new_file = not os.path.exists(self.journal_path) or os.path.getsize(self.journal_path) == 0
+				self._journal = open(self.journal_path, 'ab')
+				if new_file:
+					self._journal.write(self._journal_header())
+			self._journal.write(RECORD_HEADER.pack(kind, len(payload), zlib.crc32(payload)) + payload)
+			self._journal.flush()
+			if time.time() - self._last_fsync >= self.fsync_interval:
+				os.fsync(self._journal.fileno())
+				self._last_fsync = time.time()
+
+	def _journal_header(self):
+		layout = pickle.dumps(self.graph_columns, pickle.HIGHEST_PROTOCOL)
+		return FILE_HEADER.pack(JOURNAL_MAGIC, FORMAT_VERSION) + BLOCK_HEADER.pack(len(layout), zlib.crc32(layout)) + \
+			layout
+
+	def _snapshot_bytes(self, graph_buffer, stats_data):
+		header = pickle.dumps({'columns': self.graph_columns, 'stats': copy.deepcopy(stats_data)},
+							  pickle.HIGHEST_PROTOCOL)
+		parts = [FILE_HEADER.pack(SNAPSHOT_MAGIC, FORMAT_VERSION), BLOCK_HEADER.pack(len(header), zlib.crc32(header)),
+				 header]
+		for name in self.graph_names:
+			column = graph_buffer.ordered(name).tobytes()
+			parts.append(BLOCK_HEADER.pack(len(column), zlib.crc32(column)))
+			parts.append(column)
+		return b''.join(parts)
+
+	#
+	# Returns the graph columns and stats held in a snapshot
+	#
+	def _read_snapshot(self, data):
+		if data[:4] != SNAPSHOT_MAGIC:
+			# Version 0, a pickled dictionary
+			snapshot = pickle.loads(data)
+			return snapshot['graph'], snapshot['stats']
+		magic, version = FILE_HEADER.unpack_from(data, 0)
+		if version > FORMAT_VERSION:
+			raise ValueError("snapshot format version %d is newer than this dashboard supports" % version)
+		offset = FILE_HEADER.size
+		header, offset = self._read_block(data, offset)
+		if header is None:
+			raise ValueError("snapshot header is damaged")
+		header = pickle.loads(header)
+		columns = {}
+		for name, typecode in header['columns']:
+			block, offset = self._read_block(data, offset)
+			if block is None:
+				print("Snapshot graph column %s is damaged, using defaults from here on" % name)
+				break
+			columns[name] = array.array(typecode)
+			columns[name].frombytes(block)
+		return columns, header['stats']
+
+	@staticmethod
+	def _read_block(data, offset):
+		if offset + BLOCK_HEADER.size > len(data):
+			return None, offset
+		length, crc = BLOCK_HEADER.unpack_from(data, offset)
+		start = offset + BLOCK_HEADER.size
+		block = data[start:start + length]
+		if len(block) < length or zlib.crc32(block) != crc:
+			return None, offset
+		return block, start + length
+
+	#
+	# Returns the graph column layout and rows and the stats deltas held in a journal, along with the length of the
+	# undamaged part of it
+	#
+	def _read_journal(self, data):
+		rows = []
+		stats_deltas = []
+		graph_columns = self.graph_columns
+		if data[:4] == JOURNAL_MAGIC:
+			magic, version = FILE_HEADER.unpack_from(data, 0)
+			if version > FORMAT_VERSION:
+				raise ValueError("journal format version %d is newer than this dashboard supports" % version)
+			layout, offset = self._read_block(data, FILE_HEADER.size)
+			if layout is None:
+				return graph_columns, [], [], 0
+			graph_columns = pickle.loads(layout)
+			record_header = RECORD_HEADER
+		else:
+			offset = 0
+			record_header = RECORD_HEADER_V0
+		graph_record = struct.Struct('<' + ''.join(typecode for column, typecode in graph_columns))
+		while offset + record_header.size <= len(data):
+			fields = record_header.unpack_from(data, offset)
+			kind, length = fields[0], fields[1]
+			start = offset + record_header.size
+			payload = data[start:start + length]
+			if len(payload) < length or (len(fields) > 2 and zlib.crc32(payload) != fields[2]):
+				break
+			try:
+				if kind == GRAPH_RECORD:
+					rows.append(graph_record.unpack(payload))
+				elif kind == STATS_RECORD:
+					stats_deltas.append(pickle.loads(payload))
+				else:
+					break
+			except Exception:
+				break
+			offset = start + length
+		return graph_columns, rows, stats_deltas, offset
@@ -0,0 +1,73 @@
+import json
+import threading
+
+
+#
+# Pushes the displayed live values to every browser as Server-Sent Events.  A single thread waits for each new snapshot
+# from the pollers, renders it with render (returning a dictionary of cell id to displayed text) and works out which
+# cells changed.  The change and the full set of cells are encoded once into ready to send messages, and every
+# connected browser is handed the same bytes, so the work per update does not grow with the number of browsers.
+#
+class LiveFeed(object):
+	def __init__(self, publisher, render, keepalive=15.0):
+		self.publisher = publisher
+		self.render = render
+		self.keepalive = keepalive
+		self._condition = threading.Condition()
+		self._cells = {}
+		self._seq = 0
+		self._full_message = None
+		self._delta_message = None
+		self._thread = None
+
+	def start(self):
+		if self._thread is not None:
+			return
+		self._thread = threading.Thread(target=self._run, name='LiveFeed')
+		self._thread.daemon = True
+		self._thread.start()
+
+	#
+	# stream()
+	#   A generator of the event stream for one browser.  It starts with every cell and then carries only the cells that
+	# changed, falling back to every cell again if the browser missed an update.  Comments are sent while nothing is
+	# changing so proxies and the browser keep the connection open.
+	#
+	def stream(self):
+		seq = None
+		yield 'retry: 5000\n\n'
+		while True:
+			with self._condition:
+				self._condition.wait_for(lambda: self._seq != seq and self._full_message is not None, self.keepalive)
+				if self._seq == seq or self._full_message is None:
+					message = ': keepalive\n\n'
+				elif seq == self._seq - 1:
+					message = self._delta_message
+				else:
+					message = self._full_message
+				seq = self._seq
+			yield message
+
+	def _run(self):
+		snapshot_seq = -1
+		while True:
+			snapshot = self.publisher.wait_newer(snapshot_seq)
+			snapshot_seq = snapshot.seq
+			try:
+				cells = self.render(snapshot)
+			except Exception as e:
+				print("Failed to render the live values: " + str(e))
+				continue
+			delta = dict((cell_id, text) for cell_id, text in cells.items() if self._cells.get(cell_id) != text)
+			if not delta:
+				continue
+			with self._condition:
+				self._cells = cells
+				self._seq += 1
+				self._full_message = self._message(self._seq, cells)
+				self._delta_message = self._message(self._seq, delta)
+				self._condition.notify_all()
+
+	@staticmethod
+	def _message(seq, cells):
+		return 'id: %d\ndata: %s\n\n' % (seq, json.dumps(cells, separators=(',', ':')))
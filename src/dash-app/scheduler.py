@@ -0,0 +1,105 @@
+import concurrent.futures
+import heapq
+import threading
+import time
+
+
+#
+# A job run every interval seconds by the Scheduler, along with how it has been getting on
+#
+class ScheduledJob(object):
+	def __init__(self, name, interval, fn):
+		self.name = name
+		self.interval = interval
+		self.fn = fn
+		self.deadline = 0.0
+		self.future = None
+		self.runs = 0
+		self.missed = 0
+		self.last_duration = None
+
+
+#
+# Runs every periodic job of the dashboard from one scheduling thread.  Each job's ticks fall on absolute deadlines
+# (start, start + interval, start + 2 * interval...) so a slow run never pushes the cadence back, and the runs
+# themselves happen on a small thread pool so one job blocking on a device does not hold up the others.  A tick is
+# missed when the job's previous run is still going, or when the scheduler itself fell behind by whole intervals, and
+# missed ticks are counted and reported rather than run late in a burst.
+#
+class Scheduler(object):
+	def __init__(self, max_workers=4, report_missed=None):
+		self.report_missed = report_missed or self._print_missed
+		self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+		self._condition = threading.Condition()
+		self._queue = []
+		self._jobs = []
+		self._thread = None
+
+	#
+	# every()
+	#   Run fn (taking no arguments) every interval seconds, the first time at start (default now)
+	#
+	def every(self, name, interval, fn, start=None):
+		job = ScheduledJob(name, interval, fn)
+		job.deadline = start or time.time()
+		with self._condition:
+			self._jobs.append(job)
+			heapq.heappush(self._queue, (job.deadline, len(self._jobs), job))
+			self._condition.notify()
+		return job
+
+	def start(self):
+		if self._thread is not None:
+			return
+		self._thread = threading.Thread(target=self.run, name='Scheduler')
+		self._thread.daemon = True
+		self._thread.start()
+
+	def run(self):
+		while True:
+			with self._condition:
+				if not self._queue:
+					self._condition.wait()
+					continue
+				deadline, order, job = self._queue[0]
+				delay = deadline - time.time()
+				if delay > 0:
+					# Woken early if a job is added, in case it is due sooner
+					self._condition.wait(delay)
+					continue
+				heapq.heappop(self._queue)
+				# Whole intervals that went by before we got round to this tick are skipped, keeping to the original
+				# deadlines
+				missed = int((time.time() - deadline) // job.interval)
+				job.deadline = deadline + (missed + 1) * job.interval
+				heapq.heappush(self._queue, (job.deadline, order, job))
+			if job.future is not None and not job.future.done():
+				missed += 1
+			else:
+				job.future = self._executor.submit(self._run, job)
+			if missed:
+				job.missed += missed
+				self.report_missed(job, missed)
+
+	#
+	# stats()
+	#   How many times each job has run and missed its tick, and how long its latest run took
+	#
+	def stats(self):
+		with self._condition:
+			return dict((job.name, {'runs': job.runs, 'missed': job.missed, 'last_duration': job.last_duration})
+						for job in self._jobs)
+
+	@staticmethod
+	def _run(job):
+		start = time.time()
+		try:
+			job.fn()
+		except Exception as e:
+			print("Scheduled job %s failed: %s" % (job.name, e))
+		job.runs += 1
+		job.last_duration = time.time() - start
+
+	@staticmethod
+	def _print_missed(job, missed):
+		print("Scheduled job %s missed %d tick(s), %d in total" % (job.name, missed, job.missed))
@@ -0,0 +1,100 @@
+import pickle
+import struct
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+# Each slot starts with a sequence number and the length of the pickled value that follows it
+SLOT_HEADER = struct.Struct('<QI')
+
+
+#
+# A set of named values shared between processes through one block of shared memory, for a single writer process and
+# any number of reader processes.  Each value lives in its own fixed size slot, and is written as a pickle guarded by a
+# sequence lock: the slot's sequence number is odd while a write is in progress and goes up by two with every write.
+# Readers never take a lock.  They copy the slot and retry if the sequence number was odd or changed under them, and
+# keep the last value they unpickled so it is only unpickled again once it has changed.
+#
+class SharedState(object):
+	def __init__(self, name, slots, create=False):
+		self.name = name
+		self._slots = {}
+		offset = 0
+		for slot, size in slots:
+			self._slots[slot] = (offset, size)
+			offset += SLOT_HEADER.size + size
+		if create:
+			try:
+				# Left behind by a poller that did not shut down cleanly
+				stale = shared_memory.SharedMemory(name=name)
+				stale.close()
+				stale.unlink()
+			except FileNotFoundError:
+				pass
+			self._memory = shared_memory.SharedMemory(name=name, create=True, size=offset)
+			self._memory.buf[:offset] = bytes(offset)
+		else:
+			self._memory = shared_memory.SharedMemory(name=name)
+			# Only the creating process should remove the block when it exits
+			try:
+				resource_tracker.unregister(self._memory._name, 'shared_memory')
+			except Exception:
+				pass
+		self._cache = {}
+
+	#
+	# write()
+	#   Replace the value in a slot.  Only one process may write to a slot.
+	#
+	def write(self, slot, value):
+		payload = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+		offset, size = self._slots[slot]
+		if len(payload) > size:
+			raise ValueError("%d bytes does not fit in the %d byte %s slot" % (len(payload), size, slot))
+		buf = self._memory.buf
+		seq, length = SLOT_HEADER.unpack_from(buf, offset)
+		SLOT_HEADER.pack_into(buf, offset, seq + 1, length)
+		start = offset + SLOT_HEADER.size
+		buf[start:start + len(payload)] = payload
+		SLOT_HEADER.pack_into(buf, offset, seq + 2, len(payload))
+
+	#
+	# version()
+	#   How many times the slot has been written, without reading it
+	#
+	def version(self, slot):
+		seq, length = SLOT_HEADER.unpack_from(self._memory.buf, self._slots[slot][0])
+		return seq // 2
+
+	#
+	# read()
+	#   The version and value of a slot, or (0, default) if it has never been written
+	#
+	def read(self, slot, default=None):
+		offset, size = self._slots[slot]
+		buf = self._memory.buf
+		while True:
+			seq, length = SLOT_HEADER.unpack_from(buf, offset)
+			cached = self._cache.get(slot)
+			if cached is not None and cached[0] == seq:
+				return seq // 2, cached[1]
+			if seq == 0:
+				return 0, default
+			if seq % 2 == 0:
+				start = offset + SLOT_HEADER.size
+				payload = bytes(buf[start:start + length])
+				if SLOT_HEADER.unpack_from(buf, offset)[0] == seq:
+					try:
+						value = pickle.loads(payload)
+					except Exception:
+						# Torn by a write we raced with after all, go around again
+						continue
+					self._cache[slot] = (seq, value)
+					return seq // 2, value
+			# A write is in progress
+			time.sleep(0.001)
+
+	def close(self):
+		self._memory.close()
+
+	def unlink(self):
+		self._memory.unlink()
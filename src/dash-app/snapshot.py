@@ -0,0 +1,105 @@
+import collections
+import threading
+import time
+import types
+
+
+#
+# An immutable view of the latest live readings.  seq increases by one with every published snapshot, values maps each
+# field to its latest value and source_times holds when each source (tristar, arduino...) last published.  A snapshot
+# never changes once published, so everything read from one reference is consistent.
+#
+class Snapshot(collections.namedtuple('Snapshot', ['seq', 'values', 'source_times'])):
+	__slots__ = ()
+
+	#
+	# has()
+	#   Whether every one of the given fields has been read at least once
+	#
+	def has(self, *fields):
+		return all(field in self.values for field in fields)
+
+	def age(self, source, now=None):
+		source_time = self.source_times.get(source)
+		if source_time is None:
+			return None
+		return (now or time.time()) - source_time
+
+	# The read only views cannot be pickled, so snapshots are pickled (to share them with other processes) as plain
+	# dictionaries and made read only again when unpickled
+	def __reduce__(self):
+		return restore_snapshot, (self.seq, dict(self.values), dict(self.source_times))
+
+
+def restore_snapshot(seq, values, source_times):
+	return Snapshot(seq, types.MappingProxyType(values), types.MappingProxyType(source_times))
+
+
+#
+# Publishes the live readings of all of the pollers as a series of snapshots.  Each poller publishes the fields it read
+# in one step, which swaps in a new snapshot holding those fields on top of the previous snapshot's.  Readers just take
+# the current reference, so they never lock and never see half of a poll, and can wait for a snapshot newer than one
+# they already have.  If given, derive is called with the merged fields of each new snapshot and returns further fields
+# worked out from them (totals across devices, say) to publish along with them.
+#
+class SnapshotPublisher(object):
+	def __init__(self, derive=None):
+		self.derive = derive
+		self._condition = threading.Condition()
+		self._current = Snapshot(0, types.MappingProxyType({}), types.MappingProxyType({}))
+
+	@property
+	def current(self):
+		return self._current
+
+	#
+	# publish()
+	#   Publish the given dictionary of field values read from source, returning the new snapshot
+	#
+	def publish(self, source, values, timestamp=None):
+		timestamp = timestamp or time.time()
+		with self._condition:
+			previous = self._current
+			merged = dict(previous.values)
+			merged.update(values)
+			if self.derive is not None:
+				merged.update(self.derive(merged))
+			source_times = dict(previous.source_times)
+			source_times[source] = timestamp
+			self._current = Snapshot(previous.seq + 1, types.MappingProxyType(merged),
+									 types.MappingProxyType(source_times))
+			self._condition.notify_all()
+			return self._current
+
+	#
+	# wait_newer()
+	#   Wait for a snapshot with a sequence number greater than seq and return it, or return the current snapshot if
+	# none arrives within timeout seconds
+	#
+	def wait_newer(self, seq, timeout=None):
+		with self._condition:
+			self._condition.wait_for(lambda: self._current.seq > seq, timeout)
+			return self._current
+
+
+#
+# Follows the snapshots published in another process, as returned by read_snapshot, with the same current and
+# wait_newer() as SnapshotPublisher.  There is nothing to wake a waiter from another process, so waiting checks for a
+# newer snapshot every poll_interval seconds.
+#
+class SnapshotFollower(object):
+	def __init__(self, read_snapshot, poll_interval=0.5):
+		self.read_snapshot = read_snapshot
+		self.poll_interval = poll_interval
+
+	@property
+	def current(self):
+		return self.read_snapshot()
+
+	def wait_newer(self, seq, timeout=None):
+		deadline = None if timeout is None else time.time() + timeout
+		while True:
+			snapshot = self.read_snapshot()
+			if snapshot.seq > seq or (deadline is not None and time.time() >= deadline):
+				return snapshot
+			time.sleep(self.poll_interval)
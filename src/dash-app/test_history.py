@@ -0,0 +1,25 @@
+import sys
+import time
+from os import path
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..', 'weewx'))
+from history import HOUR, MINUTE, RollupStore
+
+
+#
+# Just after an hour boundary the hour tier's open bucket still holds the hour before, while the minute tier's open
+# bucket holds the new hour.  Each has to come back as a bucket of its own.
+#
+def test_query_partial_buckets_across_a_boundary(tmp_path, monkeypatch):
+	monkeypatch.chdir(tmp_path)
+	store = RollupStore(['watts'])
+	start = int(time.time()) // HOUR * HOUR - 3 * HOUR
+	for timestamp in range(start, start + 2 * HOUR + 1, MINUTE):
+		store.add(timestamp, {'watts': 1.0 + (timestamp - start) // HOUR})
+
+	rows = store.query(start, start + 3 * HOUR, points=3)
+
+	assert rows['time'] == [start, start + HOUR, start + 2 * HOUR]
+	assert rows['watts_mean'] == [1.0, 2.0, 3.0]
+	assert rows['watts_max'] == [1.0, 2.0, 3.0]
+	store.close()
@@ -0,0 +1,42 @@
+import time
+import requests
+
+
+#
+# The arduino serving the ACS758 current sensor readings over HTTP.  Each analog channel is read from its own path and
+# comes back as a JSON object keyed by the channel name, such as {"A0": 1.25}.  The stats of each channel are recorded
+# under the acs758 service as the name and channel, such as acs758_A0.  Without a port, address is the whole base url
+# the channel paths are added to.
+#
+class ACS758Client(object):
+	def __init__(self, address, port=80, timeout=5.0, name='acs758'):
+		self.address = address
+		self.port = port
+		self.timeout = timeout
+		self.name = name
+
+	def base_url(self):
+		if self.port is None:
+			return self.address.rstrip('/')
+		return self.address + ':' + str(self.port)
+
+	#
+	# read_channel()
+	#   Fetch the current reading of a single analog channel, recording how it went in stats if given
+	#
+	def read_channel(self, channel, stats=None):
+		try:
+			start = time.time()
+			resp = requests.get(self.base_url() + '/' + channel, timeout=self.timeout)
+			if stats is not None:
+				stats.record('acs758', self.name + '_' + channel, 'read', time.time() - start)
+			if resp.status_code != 200:
+				raise IOError("Failed to retrieve packet from ACS758: " + str(resp.status_code))
+			values = resp.json()
+		except Exception as e:
+			if stats is not None:
+				stats.failure('acs758', self.name + '_' + channel, e)
+			raise
+		if stats is not None:
+			stats.success('acs758', self.name + '_' + channel)
+		return values
@@ -0,0 +1,92 @@
+import sys
+import syslog
+import threading
+import time
+
+import configobj
+
+from ACS758Lib import ACS758Client
+from CollectorLib import SampleServer, configured_devices, device_key, new_device_collector, run_every
+from InstrumentationLib import ServiceStats
+from TristarLib import TristarConnection, TristarPoller, read_tristar
+
+#
+# The collector daemon.  A standalone process that owns all of the device I/O for the tristar charge controllers and the
+# ACS758 arduinos: it polls them every [DataCollection] poll_interval seconds and serves each sample over the Unix
+# socket named by [DataCollection] socket.  With that socket configured, the weewx services and the dashboard follow
+# the daemon's samples instead of each polling the hardware, so every device is read once for both of them.
+#
+# It takes its settings from the same weewx config file as the services:
+#
+#   python CollectorDaemon.py /etc/weewx/weewx.conf
+#
+
+
+#
+# sample_channels()
+#   Read both channels of an arduino into the cache.  Run every [ACS758] sample_interval when that is shorter than the
+# poll interval, as the weewx services work out their interval statistics from these samples, so they are taken at the
+# rate the services would sample at themselves rather than the poll interval.
+#
+def sample_channels(cache, key, acs758, stats):
+	for channel in ('A0', 'A1'):
+		try:
+			cache.update(key + '_' + channel, acs758.read_channel(channel, stats))
+		except Exception as e:
+			syslog.syslog(syslog.LOG_DEBUG, "Failed to sample %s %s: %s" % (key, channel, e))
+
+
+def main(argv):
+	config_path = argv[1] if len(argv) > 1 else '/etc/weewx/weewx.conf'
+	config_dict = configobj.ConfigObj(config_path, file_error=True)
+	collection_config = config_dict.get('DataCollection', {})
+	if 'socket' not in collection_config:
+		print("No collector daemon socket is configured in the [DataCollection] section of " + config_path)
+		return 1
+	poll_interval = float(collection_config.get('poll_interval', 15))
+	if poll_interval <= 0:
+		print("The collector daemon needs a [DataCollection] poll_interval greater than zero")
+		return 1
+
+	stats = ServiceStats()
+	# Set alongside the services' own stats file, but the daemon needs a file of its own
+	services_config = config_dict.get('DataServices', {})
+	if 'daemon_stats_file' in services_config:
+		stats.start_writer(services_config['daemon_stats_file'], float(services_config.get('stats_interval', 60)))
+
+	collector = new_device_collector(collection_config)
+	# Every device is registered under the same name the weewx services give it, see configured_devices()
+	for name, prefix, tristar_config in configured_devices(config_dict, 'Tristar'):
+		key = device_key('tristar', name)
+		tristar = TristarConnection(tristar_config['address'], port=int(tristar_config.get('port', 502)),
+									timeout=float(tristar_config.get('timeout', 3)),
+									max_backoff=float(tristar_config.get('max_backoff', 60)),
+									idle_timeout=float(tristar_config.get('idle_timeout', 120)))
+		poller = TristarPoller(tristar, tier_periods={'medium': float(tristar_config.get('medium_interval', 60)),
+													 'slow': float(tristar_config.get('slow_interval', 300))})
+		collector.register(key, lambda key=key, poller=poller: read_tristar(poller, stats, key))
+	for name, prefix, acs758_config in configured_devices(config_dict, 'ACS758'):
+		key = device_key('acs758', name)
+		acs758 = ACS758Client(acs758_config['address'], port=int(acs758_config.get('port', 80)),
+							  timeout=float(acs758_config.get('timeout', 5)), name=key)
+		sample_interval = float(acs758_config.get('sample_interval', 0))
+		if 0 < sample_interval < poll_interval:
+			sampler = threading.Thread(target=run_every, name='ACS758Sampler-' + key,
+									   args=(sample_interval, lambda key=key, acs758=acs758:
+											 sample_channels(collector.cache, key, acs758, stats)))
+			sampler.daemon = True
+			sampler.start()
+			continue
+		for channel in ('A0', 'A1'):
+			collector.register(key + '_' + channel,
+							   lambda acs758=acs758, channel=channel: acs758.read_channel(channel, stats))
+
+	server = SampleServer(collector.cache, collection_config['socket'])
+	server.start()
+	syslog.syslog(syslog.LOG_INFO, "Collector daemon serving samples on " + collection_config['socket'])
+	while True:
+		time.sleep(3600)
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))
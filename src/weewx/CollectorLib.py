@@ -0,0 +1,431 @@
+import collections
+import concurrent.futures
+import json
+import os
+import socket
+import threading
+import time
+
+
+#
+# run_every()
+#   Call fn every interval seconds until stop (a threading.Event) is set.  Calls are scheduled on absolute deadlines so
+# a slow call does not push the cadence back, and a call that overruns the next deadline starts the cadence again from
+# when it finished.
+#
+def run_every(interval, fn, stop=None):
+	stop = stop or threading.Event()
+	next_run = time.time()
+	while not stop.is_set():
+		fn()
+		next_run += interval
+		delay = next_run - time.time()
+		if delay > 0:
+			if stop.wait(delay):
+				return
+		else:
+			next_run = time.time()
+
+
+#
+# The latest reading from a device.  values holds the field values, timestamp is when the reading was taken and
+# field_times holds the time each individual field was last refreshed, so fields that a device stops reporting show up
+# as stale instead of silently disappearing.
+#
+class Sample(collections.namedtuple('Sample', ['values', 'timestamp', 'field_times'])):
+	__slots__ = ()
+
+	def age(self, now=None):
+		return (now or time.time()) - self.timestamp
+
+	def field_ages(self, now=None):
+		now = now or time.time()
+		return dict((field, now - field_time) for field, field_time in self.field_times.items())
+
+
+#
+# Holds the latest sample for every device.  Lookups are a single dictionary access, so readers such as the archive
+# handlers never wait on the device itself.  Subscribers are called with the device name and the new sample every time
+# one is stored.
+#
+class SampleCache(object):
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._samples = {}
+		self._listeners = []
+
+	def update(self, name, values, timestamp=None):
+		timestamp = timestamp or time.time()
+		with self._lock:
+			previous = self._samples.get(name)
+			field_times = dict(previous.field_times) if previous is not None else {}
+			field_times.update((field, timestamp) for field in values)
+			values = dict(previous.values, **values) if previous is not None else dict(values)
+			sample = Sample(values, timestamp, field_times)
+			self._samples[name] = sample
+		self._notify(name, sample)
+		return sample
+
+	#
+	# put()
+	#   Store a complete sample taken elsewhere, such as one received from the collector daemon
+	#
+	def put(self, name, sample):
+		with self._lock:
+			self._samples[name] = sample
+		self._notify(name, sample)
+
+	def get(self, name):
+		return self._samples.get(name)
+
+	def items(self):
+		with self._lock:
+			return list(self._samples.items())
+
+	def subscribe(self, listener):
+		self._listeners.append(listener)
+
+	def _notify(self, name, sample):
+		for listener in self._listeners:
+			try:
+				listener(name, sample)
+			except Exception:
+				pass
+
+
+#
+# Reads every registered device concurrently and keeps the latest reading of each in a SampleCache.
+#
+# With a poll interval configured, a background thread reads all of the devices at that cadence and the weewx services
+# just pick up the cached samples when an archive record arrives, so archive processing never waits on hardware.
+# Samples older than max_age are treated as missing.
+#
+# Without a poll interval the devices are read when the archive record arrives.  The services each handle the record in
+# turn, so the first service to ask for a sample for a given record starts a collection round that fans out the reads for
+# all registered devices at once.  Every service then waits only for its own device, and never beyond the round's
+# deadline.  A device that misses the deadline is filled from its last good reading, or omitted if configured to do so.
+#
+# In either mode a device whose previous read is still outstanding is not read again until that read finishes.  Unless
+# max_workers is given, every device gets a worker thread of its own so a round takes as long as the slowest device
+# rather than adding them up.
+#
+class DeviceCollector(object):
+	remote = False
+
+	def __init__(self, max_workers=None, deadline=10.0, fill_missed=True, poll_interval=0.0, max_age=300.0):
+		self.max_workers = max_workers
+		self.deadline = deadline
+		self.fill_missed = fill_missed
+		self.poll_interval = poll_interval
+		self.max_age = max_age
+		self.cache = SampleCache()
+		self._pool_size = max_workers or 1
+		self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._pool_size)
+		self._lock = threading.Lock()
+		self._readers = {}
+		self._in_flight = {}
+		self._errors = {}
+		self._round_key = None
+		self._round_deadline = 0.0
+		self._round_futures = {}
+		self._poll_thread = None
+
+	#
+	# register()
+	#   Add a device to the collection.  read_fn takes no arguments and returns a dictionary of field values, raising an
+	# exception if the device could not be read.
+	#
+	def register(self, name, read_fn):
+		with self._lock:
+			self._readers[name] = read_fn
+			if self.max_workers is None and len(self._readers) > self._pool_size:
+				# Reads already handed to the old pool still finish there
+				previous = self._executor
+				self._pool_size = len(self._readers)
+				self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._pool_size)
+				previous.shutdown(wait=False)
+			if self.poll_interval > 0 and self._poll_thread is None:
+				self._poll_thread = threading.Thread(target=run_every, args=(self.poll_interval, self._poll),
+													 name='DeviceCollector')
+				self._poll_thread.daemon = True
+				self._poll_thread.start()
+
+	#
+	# sample()
+	#   The latest sample from the named device for the archive record identified by key (normally the record
+	# timestamp).  Returns None if the device has nothing usable to report.
+	#
+	def sample(self, name, key):
+		if self.poll_interval > 0:
+			sample = self.cache.get(name)
+			if sample is None or sample.age() > self.max_age:
+				return None
+			return sample
+		with self._lock:
+			if key != self._round_key:
+				self._start_round(key)
+			future = self._round_futures.get(name)
+			deadline = self._round_deadline
+		if future is not None:
+			try:
+				return future.result(timeout=max(0.0, deadline - time.time()))
+			except Exception:
+				pass
+		if self.fill_missed:
+			return self.cache.get(name)
+		return None
+
+	#
+	# last_error()
+	#   Why the most recent read of the named device produced nothing, or None if it succeeded
+	#
+	def last_error(self, name):
+		future = self._in_flight.get(name)
+		if future is not None and not future.done():
+			return "read did not complete within the %.1f second collection deadline" % self.deadline
+		sample = self.cache.get(name)
+		if self.poll_interval > 0 and sample is not None and sample.age() > self.max_age:
+			return "latest sample is %d seconds old" % sample.age()
+		return self._errors.get(name)
+
+	def _start_round(self, key):
+		self._round_key = key
+		self._round_deadline = time.time() + self.deadline
+		self._round_futures = self._submit_all()
+
+	def _submit_all(self):
+		futures = {}
+		for name, read_fn in self._readers.items():
+			previous = self._in_flight.get(name)
+			if previous is not None and not previous.done():
+				continue
+			future = self._executor.submit(self._read, name, read_fn)
+			self._in_flight[name] = future
+			futures[name] = future
+		return futures
+
+	def _read(self, name, read_fn):
+		try:
+			values = read_fn()
+		except Exception as e:
+			self._errors[name] = e
+			raise
+		if values is None:
+			return None
+		self._errors[name] = None
+		return self.cache.update(name, values)
+
+	#
+	# One round of the background polling, run every poll interval by run_every()
+	#
+	def _poll(self):
+		with self._lock:
+			self._submit_all()
+
+
+#
+# encode_sample()
+#   A sample as one line of JSON, the form samples are sent in between processes
+#
+def encode_sample(name, sample):
+	message = {'device': name, 'values': sample.values, 'timestamp': sample.timestamp,
+			   'field_times': sample.field_times}
+	return (json.dumps(message, separators=(',', ':')) + '\n').encode('utf-8')
+
+
+def decode_sample(line):
+	message = json.loads(line.decode('utf-8'))
+	return message['device'], Sample(message['values'], message['timestamp'], message['field_times'])
+
+
+#
+# Serves the samples stored in a SampleCache to other processes over a Unix domain socket.  Every new sample is sent
+# to every connected client as one line of JSON as soon as it is stored, and a newly connected client is first sent the
+# latest sample of every device.  Each sample is encoded once however many clients there are, and a client that stops
+# reading is disconnected rather than holding up the others.
+#
+class SampleServer(object):
+	def __init__(self, cache, path, send_timeout=1.0):
+		self.cache = cache
+		self.path = path
+		self.send_timeout = send_timeout
+		self._lock = threading.Lock()
+		self._clients = []
+		self._socket = None
+
+	def start(self):
+		if os.path.exists(self.path):
+			os.unlink(self.path)
+		self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self._socket.bind(self.path)
+		self._socket.listen(8)
+		self.cache.subscribe(self._publish)
+		accept_thread = threading.Thread(target=self._accept, name='SampleServer')
+		accept_thread.daemon = True
+		accept_thread.start()
+
+	def _accept(self):
+		while True:
+			client, address = self._socket.accept()
+			client.settimeout(self.send_timeout)
+			# Sent under the lock so no new sample can overtake the initial ones
+			with self._lock:
+				try:
+					for name, sample in self.cache.items():
+						client.sendall(encode_sample(name, sample))
+				except OSError:
+					client.close()
+					continue
+				self._clients.append(client)
+
+	def _publish(self, name, sample):
+		message = encode_sample(name, sample)
+		with self._lock:
+			for client in list(self._clients):
+				try:
+					client.sendall(message)
+				except OSError:
+					client.close()
+					self._clients.remove(client)
+
+
+#
+# Follows the samples served by the collector daemon's SampleServer and keeps the latest from each device in a local
+# SampleCache.  It has the same register(), sample() and last_error() interface as DeviceCollector so the weewx services
+# work unchanged, but it never talks to the devices: registered read functions are ignored, as the daemon owns all of
+# the device I/O.  Whenever the connection drops it is re-established, backing off up to max_backoff seconds.
+#
+class CollectorClient(object):
+	remote = True
+
+	def __init__(self, path, max_age=300.0, max_backoff=30.0):
+		self.path = path
+		self.max_age = max_age
+		self.max_backoff = max_backoff
+		self.cache = SampleCache()
+		self.connected = False
+		self.error = "not connected to the collector daemon at " + path
+		self._lock = threading.Lock()
+		self._thread = None
+
+	def start(self):
+		with self._lock:
+			if self._thread is None:
+				self._thread = threading.Thread(target=self._follow, name='CollectorClient')
+				self._thread.daemon = True
+				self._thread.start()
+
+	def register(self, name, read_fn):
+		self.start()
+
+	def subscribe(self, listener):
+		self.cache.subscribe(listener)
+
+	def sample(self, name, key=None):
+		sample = self.cache.get(name)
+		if sample is None or sample.age() > self.max_age:
+			return None
+		return sample
+
+	def last_error(self, name):
+		if not self.connected:
+			return self.error
+		sample = self.cache.get(name)
+		if sample is None:
+			return "the collector daemon has no samples from " + name
+		if sample.age() > self.max_age:
+			return "latest sample is %d seconds old" % sample.age()
+		return None
+
+	def _follow(self):
+		backoff = 1.0
+		while True:
+			client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			try:
+				client.connect(self.path)
+				self.connected = True
+				backoff = 1.0
+				with client.makefile('rb') as stream:
+					for line in stream:
+						self.cache.put(*decode_sample(line))
+				self.error = "the collector daemon closed the connection"
+			except (OSError, ValueError, KeyError) as e:
+				self.error = "collector daemon connection failed: " + str(e)
+			finally:
+				client.close()
+			self.connected = False
+			time.sleep(backoff)
+			backoff = min(self.max_backoff, backoff * 2)
+
+
+#
+# new_device_collector()
+#   A DeviceCollector configured from the [DataCollection] section of the weewx config
+#
+def new_device_collector(collection_config):
+	workers = collection_config.get('workers')
+	return DeviceCollector(max_workers=int(workers) if workers else None,
+						   deadline=float(collection_config.get('deadline', 10)),
+						   fill_missed=collection_config.get('missed', 'last') == 'last',
+						   poll_interval=float(collection_config.get('poll_interval', 15)),
+						   max_age=float(collection_config.get('max_age', 300)))
+
+
+_collector = None
+_collector_lock = threading.Lock()
+
+
+#
+# get_collector()
+#   The collector shared by all of the data services in this weewx process, configured from the optional
+# [DataCollection] section of the weewx config.  If that names the socket of a running collector daemon, the services
+# follow the daemon's samples instead of reading the devices themselves.
+#
+def get_collector(config_dict):
+	global _collector
+	with _collector_lock:
+		if _collector is None:
+			collection_config = config_dict.get('DataCollection', {})
+			if 'socket' in collection_config:
+				_collector = CollectorClient(collection_config['socket'],
+											 max_age=float(collection_config.get('max_age', 300)))
+			else:
+				_collector = new_device_collector(collection_config)
+		return _collector
+
+
+#
+# device_key()
+#   The name a device of the given kind (tristar, acs758...) is collected under.  The unnamed main device of each kind
+# is collected under the kind alone.
+#
+def device_key(kind, name):
+	return kind + '_' + name if name else kind
+
+
+#
+# configured_devices()
+#   The devices configured in a device section of the weewx config, as (name, field prefix, config) tuples.  The
+# section's own address is the main device, with no name and unprefixed fields.  Each subsection is a further device
+# named after the subsection, whose fields are prefixed with its prefix option or else its name and an underscore.
+# Options other than the address not given in a subsection are taken from the section, so shared settings only need to
+# be given once:
+#
+#   [Tristar]
+#       address = 10.0.10.10
+#       timeout = 3
+#       [[array2]]
+#           address = 10.0.10.11
+#
+def configured_devices(config_dict, section):
+	device_config = config_dict.get(section)
+	if device_config is None:
+		return []
+	devices = []
+	if 'address' in device_config:
+		devices.append(('', '', device_config))
+	for name in getattr(device_config, 'sections', []):
+		merged = dict((key, device_config[key]) for key in device_config.scalars if key not in ('address', 'prefix'))
+		merged.update(device_config[name])
+		devices.append((name, merged.get('prefix', name + '_'), merged))
+	return devices
@@ -1,47 +1,55 @@
 import syslog
 import weewx
-import requests
 import RPi.GPIO as GPIO
 import schemas.wview
 import weewx.units
 import time
-import statistics
+import threading
+import queue
 
-from pymodbus.client.sync import ModbusTcpClient
 from weewx.engine import StdService
+from ACS758Lib import ACS758Client
+from CollectorLib import configured_devices, device_key, get_collector, run_every
 from DFRobot_AS3935_Lib import DFRobot_AS3935
-
-amp_data_schema = [{'battery_amp_draw', 'REAL'},
-				   {'load', 'REAL'}]
+from InstrumentationLib import get_log, get_stats
+from SampleBufferLib import RingBuffer, IntervalStatistics, summarize
+from TristarLib import TristarConnection, TristarPoller, TRISTAR_REGISTERS, read_tristar, charge_state_name
+
+amp_data_schema = [('battery_amp_draw', 'REAL'),
+				   ('load', 'REAL'),
+				   ('acs758_sample_age', 'REAL'),
+				   ('battery_amp_draw_avg', 'REAL'),
+				   ('battery_amp_draw_min', 'REAL'),
+				   ('battery_amp_draw_max', 'REAL'),
+				   ('battery_amp_hours', 'REAL'),
+				   ('load_avg', 'REAL'),
+				   ('load_min', 'REAL'),
+				   ('load_max', 'REAL'),
+				   ('load_amp_hours', 'REAL')]
 
 weewx.units.obs_group_dict['battery_amp_draw'] = 'group_amp'
 weewx.units.obs_group_dict['load'] = 'group_amp'
-
-# Define our additional supported columns and their types
-
-tristar_schema = [('battery_voltage', 'REAL'),
-				  ('battery_sense_voltage', 'REAL'),
-				  ('battery_voltage_slow', 'REAL'),
-				  ('battery_daily_minimum_voltage', 'REAL'),
-				  ('battery_daily_maximum_voltage', 'REAL'),
-				  ('target_regulation_voltage', 'REAL'),
-				  ('array_voltage', 'REAL'),
-				  ('array_charge_current', 'REAL'),
-				  ('battery_charge_current', 'REAL'),
-				  ('battery_charge_current_slow', 'REAL'),
-				  ('input_power', 'REAL'),
-				  ('output_power', 'REAL'),
-				  ('heatsink_temperature', 'REAL'),
-				  ('battery_temperature', 'REAL'),
-				  ('charge_state', 'REAL'),
-				  ('seconds_in_absorption_daily', 'REAL'),
-				  ('seconds_in_float_daily', 'REAL'),
-				  ('seconds_in_equalize_daily', 'REAL')]
+weewx.units.obs_group_dict['acs758_sample_age'] = 'group_elapsed'
+for amp_field in ('battery_amp_draw', 'load'):
+	for amp_stat in ('avg', 'min', 'max'):
+		weewx.units.obs_group_dict[amp_field + '_' + amp_stat] = 'group_amp'
+weewx.units.obs_group_dict['battery_amp_hours'] = 'group_amp_hour'
+weewx.units.obs_group_dict['load_amp_hours'] = 'group_amp_hour'
+weewx.units.USUnits['group_amp_hour'] = 'amp_hour'
+weewx.units.MetricUnits['group_amp_hour'] = 'amp_hour'
+weewx.units.MetricWXUnits['group_amp_hour'] = 'amp_hour'
+weewx.units.default_unit_format_dict['amp_hour'] = '%.2f'
+weewx.units.default_unit_label_dict['amp_hour'] = ' Ah'
+
+# Define our additional supported columns and their types.  The tristar columns are generated from the register map
+
+tristar_schema = [(r.field, 'REAL') for r in TRISTAR_REGISTERS] + [('tristar_sample_age', 'REAL')]
 
 lightning_schema = [('lightning_total_strikes', 'REAL'),
 					('lightning_avg_distance', 'REAL'),
 					('lightning_median_distance', 'REAL'),
 					('lightning_max_distance', 'REAL'),
+					('lightning_min_distance', 'REAL'),
 					('lightning_avg_intensity', 'REAL'),
 					('lightning_median_intensity', 'REAL'),
 					('lightning_max_intensity', 'REAL')]
@@ -50,197 +58,320 @@ schema_with_custom_data = schemas.wview.schema + tristar_schema + amp_data_schem
 
 # Define the schema column types for weewx types
 
-weewx.units.obs_group_dict['battery_voltage'] = 'group_volt'
-weewx.units.obs_group_dict['battery_sense_voltage'] = 'group_volt'
-weewx.units.obs_group_dict['battery_voltage_slow'] = 'group_volt'
-weewx.units.obs_group_dict['battery_daily_minimum_voltage'] = 'group_volt'
-weewx.units.obs_group_dict['battery_daily_maximum_voltage'] = 'group_volt'
-weewx.units.obs_group_dict['target_regulation_voltage'] = 'group_volt'
-weewx.units.obs_group_dict['array_voltage'] = 'group_volt'
-weewx.units.obs_group_dict['array_charge_current'] = 'group_amp'
-weewx.units.obs_group_dict['battery_charge_current'] = 'group_amp'
-weewx.units.obs_group_dict['battery_charge_current_slow'] = 'group_amp'
-weewx.units.obs_group_dict['input_power'] = 'group_power'
-weewx.units.obs_group_dict['output_power'] = 'group_power'
-weewx.units.obs_group_dict['heatsink_temperature'] = 'group_temperature'
-weewx.units.obs_group_dict['battery_temperature'] = 'group_temperature'
-weewx.units.obs_group_dict['charge_state'] = 'group_charge_state'
+for tristar_register in TRISTAR_REGISTERS:
+	weewx.units.obs_group_dict[tristar_register.field] = tristar_register.unit_group
+weewx.units.obs_group_dict['tristar_sample_age'] = 'group_elapsed'
+
 weewx.units.USUnits['group_charge_state'] = 'cstate'
 weewx.units.MetricUnits['group_charge_state'] = 'cstate'
 weewx.units.MetricWXUnits['group_charge_state'] = 'cstate'
 weewx.units.default_unit_format_dict['cstate'] = '%d'
 weewx.units.default_unit_label_dict['cstate'] = ' Charge Mode'
-weewx.units.obs_group_dict['seconds_in_absorption_daily'] = 'group_elapsed'
-weewx.units.obs_group_dict['seconds_in_float_daily'] = 'group_elapsed'
-weewx.units.obs_group_dict['seconds_in_equalize_daily'] = 'group_elapsed'
 
 
 #
-# The data service for gathering information about current draw from the arduino connected to the ACS758 current
-# draw detector.  Will add the data records to the archive packet
+# add_device_fields()
+#   Add the columns of a further device, whose fields carry the given prefix, to schema_with_custom_data and the unit
+# groups.  The services do this for every configured device as weewx starts, before the archive opens the database, so
+# a newly created database has columns for every device.  An existing database needs them added with wee_database.
+#
+def add_device_fields(prefix, device_schema):
+	columns = set(column for column, column_type in schema_with_custom_data)
+	for field, column_type in device_schema:
+		if prefix + field not in columns:
+			schema_with_custom_data.append((prefix + field, column_type))
+		weewx.units.obs_group_dict[prefix + field] = weewx.units.obs_group_dict[field]
+
+
+#
+# The data service for gathering information about current draw from the arduinos connected to the ACS758 current
+# draw detectors.  Will add the data records to the archive packet.  Every arduino configured in the [ACS758] section
+# (see configured_devices()) is collected as its own device, and its fields are added with its prefix.
 #
 class AddACS758Data(StdService):
 	def __init__(self, engine, config_dict):
 		super(AddACS758Data, self).__init__(engine, config_dict)
 
-		# Grab the configuration parameters for communication with the charge controller
+		self.devices = []
+		# Grab the configuration parameters for communication with the arduinos
 		try:
-			self.arduino_address = config_dict['ACS758']['address']
-			self.arduino_port = int(config_dict['ACS758'].get('port', 80))
+			self.stats = get_stats(config_dict)
+			self.log = get_log(config_dict)
+			# The sensor channels are read concurrently with the other devices by the shared collector, or by the
+			# collector daemon if one is configured
+			self.collector = get_collector(config_dict)
+			archive_interval = float(config_dict.get('StdArchive', {}).get('archive_interval', 300))
+			for name, prefix, acs758_config in configured_devices(config_dict, 'ACS758'):
+				key = device_key('acs758', name)
+				client = ACS758Client(acs758_config['address'], port=int(acs758_config.get('port', 80)),
+									  timeout=float(acs758_config.get('timeout', 5)), name=key)
+				self.devices.append(ACS758Device(key, prefix, client, self.collector, self.stats, self.log,
+												 float(acs758_config.get('sample_interval', 0)), archive_interval))
+				if prefix:
+					add_device_fields(prefix, amp_data_schema)
+				syslog.syslog(syslog.LOG_INFO, "ACS758 %(key)s configured for address %(address)s port %(port)d" %
+							  {"key": key, "address": client.address, "port": client.port})
+			if not self.devices:
+				raise KeyError('ACS758')
 
 			# Bind to any new archive record events:
 			self.bind(weewx.NEW_ARCHIVE_RECORD, self.new_archive_packet)
-			syslog.syslog(syslog.LOG_INFO, "ACS758 configured for address %(address)s port %(port)d" %
-						  {"address": self.arduino_address, "port": self.arduino_port})
 		except KeyError as e:
-			syslog.syslog(syslog.LOG_ERR, "Tristar failed to configure")
+			syslog.syslog(syslog.LOG_ERR, "ACS758 failed to configure")
 
+	#
+	# new_archive_packet()
+	#   Called by weewx when a new archive packet is received.  Add the latest collected sensor readings of every
+	# arduino to the archive packet.
+	#
 	def new_archive_packet(self, event):
-		resp = requests.get(self.arduino_address + ':' + str(self.arduino_port) + '/A0')
-		if resp.status_code == 200:
-			syslog.syslog(syslog.LOG_INFO, "Successfully got battery amps from ACS758")
-			dict_result = resp.json()
-			event.record['battery_amp_draw'] = dict_result['A0']
-		else:
-			syslog.syslog(syslog.LOG_ERR, "Failed to retrieve packet from ACS758: " + str(resp.status_code))
-		resp = requests.get(self.arduino_address + ':' + str(self.arduino_port) + '/A1')
-		if resp.status_code == 200:
-			syslog.syslog(syslog.LOG_INFO, "Successfully got battery amps from ACS758")
-			dict_result = resp.json()
-			event.record['load'] = dict_result['A1']
-		else:
-			syslog.syslog(syslog.LOG_ERR, "Failed to retrieve packet from ACS758: " + str(resp.status_code))
+		start = time.time()
+		for device in self.devices:
+			device.add_to_record(event.record)
+		self.stats.record('acs758', 'service', 'archive', time.time() - start)
+
+	#
+	# shutDown()
+	#   Called by weewx when the engine stops or reloads.  Stop the samplers so they don't keep reading the arduinos.
+	#
+	def shutDown(self):
+		for device in self.devices:
+			device.close()
+
+
+#
+# One arduino's pair of ACS758 channels, collected as key_A0 and key_A1 and added to the record with the given field
+# prefix.  If a sample interval is configured, both channels are also sampled at that rate into a ring buffer, and the
+# mean, minimum, maximum and amp hours over each archive interval are added to the record, as the loads on these
+# channels are far too spiky for a single reading to represent.  Without a collector daemon the sampler is then the
+# only reader of the arduino, and publishes its readings into the collector's cache as key_A0 and key_A1.
+#
+class ACS758Device(object):
+	def __init__(self, key, prefix, client, collector, stats, log, sample_interval, archive_interval):
+		self.key = key
+		self.prefix = prefix
+		self.acs758 = client
+		self.collector = collector
+		self.stats = stats
+		self.log = log
+
+		# Optionally sample both channels on our own timer for the interval statistics
+		self.sample_interval = sample_interval
+		self.publishes_samples = self.sample_interval > 0 and not self.collector.remote
+		self.sample_error = None
+		self.stop = threading.Event()
+		if not self.publishes_samples:
+			self.collector.register(key + '_A0', lambda: self.read_channel('A0'))
+			self.collector.register(key + '_A1', lambda: self.read_channel('A1'))
+		# Samples further apart than this (the arduino stopped answering) are not integrated across for the amp hours
+		self.max_gap = 5 * sample_interval
+		self.samples = None
+		self.previous_sample = None
+		if self.sample_interval > 0:
+			# Room for two full archive intervals, in case an archive record is late
+			self.samples = RingBuffer(int(2 * archive_interval / self.sample_interval) + 1,
+									  [('time', 'd'), ('A0', 'd'), ('A1', 'd')])
+			self.last_sample_time = None
+			sample_thread = threading.Thread(target=run_every,
+											 args=(self.sample_interval, self.sample_channels, self.stop),
+											 name='ACS758Sampler-' + key)
+			sample_thread.daemon = True
+			sample_thread.start()
+
+	#
+	# close()
+	#   Stop the sampler thread
+	#
+	def close(self):
+		self.stop.set()
+
+	#
+	# read_channel()
+	#   Fetch the current reading of a single analog channel from the arduino
+	#
+	def read_channel(self, channel):
+		return self.acs758.read_channel(channel, self.stats)
+
+	#
+	# read_sample()
+	#   The time and readings of both channels for the interval statistics.  With a collector daemon these are its
+	# latest samples, as it owns the arduino, otherwise the channels are read directly.
+	#
+	def read_sample(self):
+		if self.collector.remote:
+			a0 = self.collector.sample(self.key + '_A0')
+			a1 = self.collector.sample(self.key + '_A1')
+			if a0 is None or a1 is None:
+				raise IOError(self.collector.last_error(self.key + ('_A0' if a0 is None else '_A1')))
+			return max(a0.timestamp, a1.timestamp), a0.values['A0'], a1.values['A1']
+		sample_time = time.time()
+		return sample_time, self.read_channel('A0')['A0'], self.read_channel('A1')['A1']
+
+	#
+	# sample_channels()
+	#   Read both channels into the ring buffer, and into the collector's cache when there is no daemon, run every
+	# sample interval by run_every()
+	#
+	def sample_channels(self):
+		try:
+			sample_time, a0, a1 = self.read_sample()
+			# The daemon may not have a newer sample yet
+			if sample_time != self.last_sample_time:
+				self.samples.append(sample_time, a0, a1)
+				self.last_sample_time = sample_time
+			if self.publishes_samples:
+				self.collector.cache.update(self.key + '_A0', {'A0': a0}, sample_time)
+				self.collector.cache.update(self.key + '_A1', {'A1': a1}, sample_time)
+			self.sample_error = None
+		except Exception as e:
+			self.sample_error = e
+			self.log.debug("Failed to sample %s: %s", self.key, e)
+
+	#
+	# latest_sample()
+	#   The latest reading of a channel for the archive record, from the sampler's own readings if it publishes them
+	# or else from the collector
+	#
+	def latest_sample(self, channel, record_time):
+		if self.publishes_samples:
+			sample = self.collector.cache.get(self.key + '_' + channel)
+			if sample is None or sample.age() > self.collector.max_age:
+				return None
+			return sample
+		return self.collector.sample(self.key + '_' + channel, record_time)
+
+	#
+	# sample_failure()
+	#   Why there is no usable reading of a channel
+	#
+	def sample_failure(self, channel):
+		if self.publishes_samples:
+			sample = self.collector.cache.get(self.key + '_' + channel)
+			if sample is not None and sample.age() > self.collector.max_age:
+				return "latest sample is %d seconds old: %s" % (sample.age(), self.sample_error)
+			return self.sample_error
+		return self.collector.last_error(self.key + '_' + channel)
+
+	#
+	# add_interval_statistics()
+	#   Summarize the samples taken since the last archive record into the record
+	#
+	def add_interval_statistics(self, record):
+		columns = self.samples.drain()
+		if len(columns['time']) == 0:
+			self.log.error("No %s samples were taken during the archive interval", self.key)
+			return
+		for channel, field, hours_field in (('A0', 'battery_amp_draw', 'battery_amp_hours'),
+											('A1', 'load', 'load_amp_hours')):
+			previous = None
+			if self.previous_sample is not None:
+				previous = (self.previous_sample['time'], self.previous_sample[channel])
+			stats = summarize(columns['time'], columns[channel], previous, self.max_gap)
+			record[self.prefix + field + '_avg'] = stats['mean']
+			record[self.prefix + field + '_min'] = stats['min']
+			record[self.prefix + field + '_max'] = stats['max']
+			record[self.prefix + hours_field] = stats['hours']
+		self.previous_sample = dict((name, column[-1]) for name, column in columns.items())
+
+	#
+	# add_to_record()
+	#   Add the latest collected readings of both channels to the archive record along with the age of the oldest of
+	# them, and the interval statistics if sampling
+	#
+	def add_to_record(self, record):
+		if self.samples is not None:
+			self.add_interval_statistics(record)
+		ages = []
+		for channel, field in (('A0', 'battery_amp_draw'), ('A1', 'load')):
+			sample = self.latest_sample(channel, record['dateTime'])
+			if sample is not None:
+				ages.append(sample.age())
+				self.log.info("Successfully got %s from %s (%.1f seconds old)", field, self.key, ages[-1])
+				record[self.prefix + field] = sample.values[channel]
+			else:
+				self.log.error("Failed to retrieve %s from %s: %s", field, self.key, self.sample_failure(channel))
+		if ages:
+			record[self.prefix + 'acs758_sample_age'] = max(ages)
 
 
 #
 # The data service implementation class itself.  Adds charge controller parameters to the weather record (archive)
-# at the time it is received from weewx.  These will be persisted by weewx to the database for later consumption
+# at the time it is received from weewx.  These will be persisted by weewx to the database for later consumption.
+# Every charge controller configured in the [Tristar] section (see configured_devices()) is collected as its own device,
+# and its fields are added with its prefix.
 #
 class AddTristarData(StdService):
 	def __init__(self, engine, config_dict):
 		# Initialize Superclass
 		super(AddTristarData, self).__init__(engine, config_dict)
 
-		# Grab the configuration parameters for communication with the charge controller
+		# The (collector key, field prefix, connection) of each charge controller
+		self.devices = []
+		# Grab the configuration parameters for communication with the charge controllers
 		try:
-			self.tristar_address = config_dict['Tristar']['address']
-			self.tristar_port = int(config_dict['Tristar'].get('port', 502))
+			self.collector = get_collector(config_dict)
+			self.stats = get_stats(config_dict)
+			self.log = get_log(config_dict)
+			for name, prefix, tristar_config in configured_devices(config_dict, 'Tristar'):
+				key = device_key('tristar', name)
+				connection = TristarConnection(tristar_config['address'], port=int(tristar_config.get('port', 502)),
+											   timeout=float(tristar_config.get('timeout', 3)),
+											   max_backoff=float(tristar_config.get('max_backoff', 60)),
+											   idle_timeout=float(tristar_config.get('idle_timeout', 120)))
+				poller = TristarPoller(connection, tier_periods={
+					'medium': float(tristar_config.get('medium_interval', 60)),
+					'slow': float(tristar_config.get('slow_interval', 300))})
+				self.collector.register(key, lambda key=key, poller=poller: self.read_tristar(key, poller))
+				if prefix:
+					add_device_fields(prefix, tristar_schema)
+				self.devices.append((key, prefix, connection))
+				syslog.syslog(syslog.LOG_INFO, "Tristar %(key)s configured for address %(address)s port %(port)d" %
+							  {"key": key, "address": connection.address, "port": connection.port})
+			if not self.devices:
+				raise KeyError('Tristar')
 
 			# Bind to any new archive record events:
 			self.bind(weewx.NEW_ARCHIVE_RECORD, self.new_archive_packet)
-			syslog.syslog(syslog.LOG_INFO,
-						  "Tristar configured for address %(address)s port %(port)d" % {"address": self.tristar_address,
-																						"port": self.tristar_port})
 		except KeyError as e:
 			syslog.syslog(syslog.LOG_ERR, "Tristar failed to configure")
 
+	#
+	# read_tristar()
+	#   Read and decode the registers that are due from a charge controller.  Runs on a collector thread, never on the
+	# weewx engine thread.
+	#
+	def read_tristar(self, key, poller):
+		return read_tristar(poller, self.stats, key)
+
 	#
 	# new_archive_packet()
-	#   Called by weewx when a new archive packet is received.  Talk to the charge controller and grab the current
-	# values from modbus and append to the current archive packet.
+	#   Called by weewx when a new archive packet is received.  Pick up the latest values collected from each charge
+	# controller and append them to the current archive packet, along with how old they are.
 	#
 	def new_archive_packet(self, event):
-		client = ModbusTcpClient(self.tristar_address, port=self.tristar_port)
-		try:
-			client.connect()
-			rr = client.read_holding_registers(0, 92, unit=1)
-			if rr is None:
-				client.close()
-				syslog.syslog(syslog.LOG_ERR, "Failed to connect to tristar")
-			else:
-				syslog.syslog(syslog.LOG_INFO, "Successfully retrieved packet from Tristar")
-				voltage_scaling_factor = (float(rr.registers[0]) + (float(rr.registers[1]) / 100))
-				amperage_scaling_factor = (float(rr.registers[2]) + (float(rr.registers[3]) / 100))
-
-				# Voltage Related Statistics
-				battery_voltage = float(rr.registers[24]) * voltage_scaling_factor * 2 ** (-15)
-				syslog.syslog(syslog.LOG_DEBUG, "Battery Voltage: %.2f" % battery_voltage)
-				event.record['battery_voltage'] = battery_voltage
-
-				battery_sense_voltage = float(rr.registers[26]) * voltage_scaling_factor * 2 ** (-15)
-				syslog.syslog(syslog.LOG_DEBUG, "Battery Sense Voltage: %.2f" % battery_sense_voltage)
-				event.record['battery_sense_voltage'] = battery_sense_voltage
-
-				battery_voltage_slow = float(rr.registers[38]) * voltage_scaling_factor * 2 ** (-15)
-				syslog.syslog(syslog.LOG_DEBUG, "Battery Voltage (Slow): %.2f" % battery_voltage_slow)
-				event.record['battery_voltage_slow'] = battery_voltage_slow
-
-				battery_daily_minimum_voltage = float(rr.registers[64]) * voltage_scaling_factor * 2 ** (-15)
-				syslog.syslog(syslog.LOG_DEBUG, "Battery Daily Minimum Voltage: %.2f" % battery_daily_minimum_voltage)
-				event.record['battery_daily_minimum_voltage'] = battery_daily_minimum_voltage
-
-				battery_daily_maximum_voltage = float(rr.registers[65]) * voltage_scaling_factor * 2 ** (-15)
-				syslog.syslog(syslog.LOG_DEBUG, "Battery Daily Maximum Voltage: %.2f" % battery_daily_maximum_voltage)
-				event.record['battery_daily_maximum_voltage'] = battery_daily_maximum_voltage
-
-				target_regulation_voltage = float(rr.registers[51]) * voltage_scaling_factor * 2 ** (-15)
-				syslog.syslog(syslog.LOG_DEBUG, "Target Regulation Voltage: %.2f" % target_regulation_voltage)
-				event.record['target_regulation_voltage'] = target_regulation_voltage
-
-				array_voltage = float(rr.registers[27]) * voltage_scaling_factor * 2 ** (-15)
-				syslog.syslog(syslog.LOG_DEBUG, "Array Voltage: %.2f" % array_voltage)
-				event.record['array_voltage'] = array_voltage
-
-				# Current Related Statistics
-				array_charge_current = float(rr.registers[29]) * amperage_scaling_factor * 2 ** (-15)
-				syslog.syslog(syslog.LOG_DEBUG, "Array Charge Current: %.2f" % array_charge_current)
-				event.record['array_charge_current'] = array_charge_current
-
-				battery_charge_current = float(rr.registers[28]) * amperage_scaling_factor * 2 ** (-15)
-				syslog.syslog(syslog.LOG_DEBUG, "Battery Charge Current: %.2f" % battery_charge_current)
-				event.record['battery_charge_current'] = battery_charge_current
-
-				battery_charge_current_slow = float(rr.registers[39]) * amperage_scaling_factor * 2 ** (-15)
-				syslog.syslog(syslog.LOG_DEBUG, "Battery Charge Current (slow): %.2f" % battery_charge_current_slow)
-				event.record['battery_charge_current_slow'] = battery_charge_current_slow
-
-				# Wattage Related Statistics
-				input_power = float(rr.registers[59]) * voltage_scaling_factor * amperage_scaling_factor * 2 ** (-17)
-				syslog.syslog(syslog.LOG_DEBUG, "Array Input Power: %.2f" % input_power)
-				event.record['input_power'] = input_power
-
-				output_power = float(rr.registers[58]) * voltage_scaling_factor * amperage_scaling_factor * 2 ** (-17)
-				syslog.syslog(syslog.LOG_DEBUG, "Controller Output Power: %.2f" % output_power)
-				event.record['output_power'] = output_power
-
-				# Temperature Statistics
-				heatsink_temperature = rr.registers[35]
-				syslog.syslog(syslog.LOG_DEBUG, "Heatsink Temperature: %(c)d %(f).1f" % {"c": heatsink_temperature,
-																						 "f": 9.0 / 5.0 * heatsink_temperature + 32})
-				event.record['heatsink_temperature'] = heatsink_temperature
-
-				battery_temperature = rr.registers[36]
-				syslog.syslog(syslog.LOG_DEBUG, "Battery Temperature: %(c)d %(f).1f" % {"c": battery_temperature,
-																						"f": 9.0 / 5.0 * battery_temperature + 32})
-				event.record['battery_temperature'] = battery_temperature
-
-				# Misc Statistics
-				charge_states = ["START", "NIGHT_CHECK", "DISCONNECT", "NIGHT", "FAULT", "MPPT", "ABSORPTION", "FLOAT",
-								 "EQUALIZE",
-								 "SLAVE"]
-				charge_state = rr.registers[50]
-				syslog.syslog(syslog.LOG_DEBUG,
-							  "Charge State %(chargeState)d - %(stateName)s" % {"chargeState": charge_state,
-																				"stateName": charge_states[
-																					charge_state]})
-				event.record['charge_state'] = charge_state
-
-				seconds_in_absorption_daily = rr.registers[77]
-				syslog.syslog(syslog.LOG_DEBUG, "Seconds in Absorption: %(seconds)d (%(minutes).1f minutes)" % {
-					"seconds": seconds_in_absorption_daily, "minutes": float(seconds_in_absorption_daily) / 60})
-				event.record['seconds_in_absorption_daily'] = seconds_in_absorption_daily
-
-				seconds_in_float_daily = rr.registers[79]
-				syslog.syslog(syslog.LOG_DEBUG, "Seconds in Float: %d" % seconds_in_float_daily)
-				event.record['seconds_in_float_daily'] = seconds_in_float_daily
-
-				seconds_in_equalization_daily = rr.registers[78]
-				syslog.syslog(syslog.LOG_DEBUG, "Seconds in Equalization: %d" % seconds_in_equalization_daily)
-				event.record['seconds_in_equalization_daily'] = seconds_in_equalization_daily
-				client.close()
-		except Exception as e:
-			syslog.syslog(syslog.LOG_ERR, "Error processing record from tristar: " + str(e))
-			client.close()
+		start = time.time()
+		for key, prefix, connection in self.devices:
+			try:
+				sample = self.collector.sample(key, event.record['dateTime'])
+				if sample is None:
+					self.log.error("Failed to retrieve packet from %s: %s", key, self.collector.last_error(key))
+				else:
+					event.record.update((prefix + field, value) for field, value in sample.values.items())
+					event.record[prefix + 'tristar_sample_age'] = sample.age()
+					self.log.info("Successfully retrieved packet from %s (%.1f seconds old)", key, sample.age())
+					# One structured line per poll, only built when debug logging is on
+					if self.log.debug_enabled:
+						values = dict(sample.values)
+						values['charge_state_name'] = charge_state_name(values['charge_state'])
+						values['oldest_field_age'] = max(sample.field_ages().values())
+						self.log.record(key, values)
+			except Exception as e:
+				self.log.error("Error processing record from %s: %s", key, e)
+		self.stats.record('tristar', 'service', 'archive', time.time() - start)
+
+	def shutDown(self):
+		for key, prefix, connection in self.devices:
+			connection.close()
 
 
 #
@@ -252,7 +383,18 @@ class AddLightningData(StdService):
 		# Initialize Superclass
 		super(AddLightningData, self).__init__(engine, config_dict)
 
-		self.lightning_data = []
+		# Strikes are accumulated per archive interval.  Only the first max_strikes of an interval are kept for the
+		# medians, the remaining statistics cover every strike.
+		max_strikes = int(config_dict.get('Lightning', {}).get('max_strikes', 1000))
+		self.lightning_data = IntervalStatistics(['strike_distance', 'strike_intensity'], capacity=max_strikes)
+		# Interrupt edges waiting for the worker thread to read the sensor.  Edges arriving while this is full are
+		# dropped and counted.
+		self.pending_edges = queue.Queue(maxsize=int(config_dict.get('Lightning', {}).get('max_pending', 100)))
+		self.edges_seen = 0
+		self.edges_processed = 0
+		self.edges_dropped = 0
+		self.stats = get_stats(config_dict)
+		self.log = get_log(config_dict)
 		# Grab the configuration parameters for communication with the charge controller
 		try:
 			GPIO.setmode(GPIO.BOARD)
@@ -278,6 +420,9 @@ class AddLightningData(StdService):
 				# used to modify SREJ (spike rejection),values should only be between 0x00 and 0x0F (0 and 7)
 				self.sensor.setSpikeRejection(2)
 
+				interrupt_thread = threading.Thread(target=self.process_interrupts, name='LightningInterrupts')
+				interrupt_thread.daemon = True
+				interrupt_thread.start()
 				GPIO.setup(7, GPIO.IN)
 				GPIO.add_event_detect(7, GPIO.RISING, callback=self.gpio_callback)
 			else:
@@ -285,49 +430,94 @@ class AddLightningData(StdService):
 		except KeyError as e:
 			syslog.syslog(syslog.LOG_ERR, "Lightning detector failed to configure")
 
+	#
+	# gpio_callback()
+	#   Runs on the RPi.GPIO event thread for every rising edge of the sensor's IRQ pin.  This only timestamps the edge
+	# and queues it, so that no edges are missed while the sensor is being read.
+	#
 	def gpio_callback(self, channel):
-		syslog.syslog(syslog.LOG_INFO, "Received Lightning Interrupt")
-		time.sleep(0.005)
-		intSrc = self.sensor.getInterruptSrc()
+		self.edges_seen += 1
+		try:
+			self.pending_edges.put_nowait(time.time())
+		except queue.Full:
+			self.edges_dropped += 1
+
+	#
+	# process_interrupts()
+	#   Worker thread reading the sensor for queued interrupt edges.  All edges waiting when the worker wakes up are
+	# handled as one batch.
+	#
+	def process_interrupts(self):
+		while True:
+			edges = [self.pending_edges.get()]
+			while True:
+				try:
+					edges.append(self.pending_edges.get_nowait())
+				except queue.Empty:
+					break
+			for edge_time in edges:
+				try:
+					self.process_interrupt(edge_time)
+				except Exception as e:
+					self.log.error("Failed to read lightning sensor: %s", e)
+				self.edges_processed += 1
+			self.log.debug("Processed %d lightning interrupts", len(edges))
+
+	def process_interrupt(self, edge_time):
+		# The interrupt register is only valid 2ms after the IRQ pin goes high, see page 22 of the datasheet
+		delay = edge_time + 0.002 - time.time()
+		if delay > 0:
+			time.sleep(delay)
+		try:
+			with self.stats.timed('lightning', 'as3935', 'read'):
+				intSrc, distance, intensity = self.sensor.getStrikeData(delay=0)
+		except Exception as e:
+			self.stats.failure('lightning', 'as3935', e)
+			raise
+		self.stats.success('lightning', 'as3935')
+		self.stats.record('lightning', 'as3935', 'latency', time.time() - edge_time)
 		if intSrc == 1:
-			syslog.syslog(syslog.LOG_INFO, "Lightning Detected")
-			# Add in the new record to the list of records
-			self.lightning_data.append({
-				'strike_distance': self.sensor.getLightningDistKm(),
-				'strike_intensity': self.sensor.getStrikeEnergyRaw()
+			self.log.info("Lightning Detected")
+			# Add the strike to the current interval's statistics
+			self.lightning_data.add({
+				'strike_distance': distance,
+				'strike_intensity': intensity
 			})
 		elif intSrc == 3:
-			syslog.syslog(syslog.LOG_ERR, "Lightning Detector Noise Level Too High")
-		else:
-			pass
+			self.log.error("Lightning Detector Noise Level Too High")
 
 	#
 	# new_archive_packet()
-	#   Called by weewx when a new archive packet is received.  Talk to the charge controller and grab the current
-	# values from modbus and append to the current archive packet.
+	#   Called by weewx when a new archive packet is received.  Take the strike statistics gathered over the archive
+	# interval, start a new interval and append the statistics to the current archive packet.
 	#
 	def new_archive_packet(self, event):
-		if len(self.lightning_data) > 0:
-			syslog(syslog.LOG_INFO, "Lightning strikes detected, processing info")
-			event.record['lightning_total_strikes'] = len(self.lightning_data)
-			distances = []
-			intensities = []
-			for rec in self.lightning_data:
-				distances.append(rec['strike_distance'])
-				intensities.append(rec['strike_intensity'])
-			event.record['lightning_avg_distance'] = statistics.mean(distances)
-			event.record['lightning_median_distance'] = statistics.median(distances)
-			event.record['lightning_max_distance'] = max(distances)
-			event.record['lightning_min_distance'] = min(distances)
-			event.record['lightning_avg_intensity'] = statistics.mean(intensities)
-			event.record['lightning_median_intensity'] = statistics.median(intensities)
-			event.record['lightning_max_intensity'] = max(intensities)
+		start = time.time()
+		interval = self.lightning_data.swap()
+		self.log.debug("Lightning interrupt edges seen %d, processed %d, dropped %d", self.edges_seen,
+					   self.edges_processed, self.edges_dropped)
+		self.stats.counter('lightning', 'as3935', 'edges_seen', self.edges_seen)
+		self.stats.counter('lightning', 'as3935', 'edges_processed', self.edges_processed)
+		self.stats.counter('lightning', 'as3935', 'edges_dropped', self.edges_dropped)
+		distances = interval['strike_distance']
+		intensities = interval['strike_intensity']
+		if distances.count > 0:
+			self.log.info("Lightning strikes detected, processing info")
+			event.record['lightning_total_strikes'] = distances.count
+			event.record['lightning_avg_distance'] = distances.mean
+			event.record['lightning_median_distance'] = distances.median
+			event.record['lightning_max_distance'] = distances.max
+			event.record['lightning_min_distance'] = distances.min
+			event.record['lightning_avg_intensity'] = intensities.mean
+			event.record['lightning_median_intensity'] = intensities.median
+			event.record['lightning_max_intensity'] = intensities.max
 		else:
 			event.record['lightning_total_strikes'] = 0
 			event.record['lightning_avg_distance'] = 0
 			event.record['lightning_median_distance'] = 0
 			event.record['lightning_max_distance'] = 0
+			event.record['lightning_min_distance'] = 0
 			event.record['lightning_avg_intensity'] = 0
 			event.record['lightning_median_intensity'] = 0
 			event.record['lightning_max_intensity'] = 0
-
+		self.stats.record('lightning', 'service', 'archive', time.time() - start)
@@ -2,20 +2,35 @@ import time
 import smbus
 
 
+#number of registers in the register file that we keep a shadow copy of (0x00 - 0x08)
+NUM_REGISTERS = 9
+
 class DFRobot_AS3935:
 	def __init__(self, address, bus = 1):
 		self.address = address
 		self.i2cbus = smbus.SMBus(bus)
+		#shadow copy of registers 0x00 - 0x08, so setters do not need to read before and after each write
+		self.shadow = None
 
 	def writeByte(self, register, value):
 		try:
 			self.i2cbus.write_byte_data(self.address, register, value)
+			if self.shadow is not None and register < NUM_REGISTERS:
+				self.shadow[register] = value
 			return 1
 		except:
 			return 0
 
 	def readData(self, register):
-		self.register = self.i2cbus.read_i2c_block_data(self.address, register)
+		#only fetch the single register asked for rather than a full 32 byte block
+		self.register = self.i2cbus.read_i2c_block_data(self.address, register, 1)
+		if self.shadow is not None and register < NUM_REGISTERS:
+			self.shadow[register] = self.register[0]
+
+	def readRegisters(self):
+		#fetch the whole 0x00 - 0x08 register block in one bus transaction and refresh the shadow copy
+		self.shadow = self.i2cbus.read_i2c_block_data(self.address, 0x00, NUM_REGISTERS)
+		return self.shadow
 
 	def manualCal(self, capacitance, location, disturber):
 		self.powerUp()
@@ -40,8 +55,7 @@ class DFRobot_AS3935:
 		else:
 			self.singRegWrite(0x08, 0x0F, capVal >> 3) #set capacitance bits
 
-		self.singRegRead(0x08)
-		#print('capacitance set to 8x%d'%(self.register[0] & 0x0F))
+		#print('capacitance set to 8x%d'%(self.shadow[0x08] & 0x0F))
 
 	def powerUp(self):
 		#register 0x00, PWD bit: 0 (clears PWD)
@@ -78,28 +92,33 @@ class DFRobot_AS3935:
 		print("enable disturber detection")
 
 	def singRegWrite(self, regAdd, dataMask, regData):
-		#start by reading original register data (only modifying what we need to)
-		self.singRegRead(regAdd)
+		#start from the shadow copy of the original register data (only modifying what we need to), fetching the
+		#register file once if we do not have a copy yet
+		if self.shadow is None:
+			self.readRegisters()
 		#calculate new register data... 'delete' old targeted data, replace with new data
 		#note: 'dataMask' must be bits targeted for replacement
 		#add'l note: this function does NOT shift values into the proper place... they need to be there already
-		newRegData = (self.register[0] & ~dataMask)|(regData & dataMask)
-		#finally, write the data to the register
+		newRegData = (self.shadow[regAdd] & ~dataMask)|(regData & dataMask)
+		#finally, write the data to the register, which also updates the shadow copy
 		self.writeByte(regAdd, newRegData)
 		#print('wrt: %02x'%newRegData)
-		self.singRegRead(regAdd)
-		#print('Act: %02x'%self.register[0])
 
 	def singRegRead(self,regAdd):
 		self.readData(regAdd)
 
-	def getInterruptSrc(self):
+	def getInterruptSrc(self, delay = 0.03):
 		#definition of interrupt data on table 18 of datasheet
 		#for this function:
 		#0 = unknown src, 1 = lightning detected, 2 = disturber, 3 = Noise level too high
-		time.sleep(0.03) #wait 3ms before reading (min 2ms per pg 22 of datasheet)
+		#delay lets callers that already know when the IRQ fired skip waiting again
+		if delay > 0:
+			time.sleep(delay) #wait 3ms before reading (min 2ms per pg 22 of datasheet)
 		self.singRegRead(0x03) #read register, get rid of non-interrupt data
-		intSrc = self.register[0]&0x0F
+		return self.decodeInterruptSrc(self.register[0])
+
+	def decodeInterruptSrc(self, reg3):
+		intSrc = reg3&0x0F
 		if intSrc == 0x08:
 			return 1 #lightning caused interrupt
 		elif intSrc == 0x04:
@@ -109,9 +128,20 @@ class DFRobot_AS3935:
 		else:
 			return 0 #interrupt result not expected
 
+	def getStrikeData(self, delay = 0.03):
+		#read the interrupt source, distance and energy of a strike in a single bus transaction
+		#returns (interrupt source as for getInterruptSrc, distance in km, raw energy)
+		if delay > 0:
+			time.sleep(delay) #min 2ms after the IRQ before reading, per pg 22 of datasheet
+		regs = self.readRegisters()
+		return (self.decodeInterruptSrc(regs[0x03]), self.decodeLightningDistKm(regs),
+				self.decodeStrikeEnergyRaw(regs))
+
 	def reset(self):
 		err = self.writeByte(0x3C, 0x96)
 		time.sleep(0.002) #wait 2ms to complete
+		#registers are back to their power on defaults, so the shadow copy is no longer valid
+		self.shadow = None
 		return err
 
 	def setLcoFdiv(self,fdiv):
@@ -135,14 +165,18 @@ class DFRobot_AS3935:
 		self.singRegRead(0x07) #read register, get rid of non-distance data
 		return self.register[0]&0x3F
 
+	def decodeLightningDistKm(self, regs):
+		return regs[0x07]&0x3F
+
 	def getStrikeEnergyRaw(self):
-		self.singRegRead(0x06) #MMSB, shift 8  bits left, make room for MSB
-		nrgyRaw = (self.register[0]&0x1F) << 8
-		self.singRegRead(0x05) #read MSB
-		nrgyRaw |= self.register[0]
+		#all three energy registers in one bus transaction
+		return self.decodeStrikeEnergyRaw(self.readRegisters())
+
+	def decodeStrikeEnergyRaw(self, regs):
+		nrgyRaw = (regs[0x06]&0x1F) << 8 #MMSB, shift 8  bits left, make room for MSB
+		nrgyRaw |= regs[0x05] #MSB
 		nrgyRaw <<= 8 #shift 8 bits left, make room for LSB
-		self.singRegRead(0x04) #read LSB, add to others
-		nrgyRaw |= self.register[0]
+		nrgyRaw |= regs[0x04] #LSB, add to others
 
 		return nrgyRaw/16777
 
@@ -221,21 +255,6 @@ class DFRobot_AS3935:
 		self.singRegWrite(0x02, 0x0F, srej & 0x0F)
 
 	def printAllRegs(self):
-		self.singRegRead(0x00)
-		print("Reg 0x00: %02x"%self.register[0])
-		self.singRegRead(0x01)
-		print("Reg 0x01: %02x"%self.register[0])
-		self.singRegRead(0x02)
-		print("Reg 0x02: %02x"%self.register[0])
-		self.singRegRead(0x03)
-		print("Reg 0x03: %02x"%self.register[0])
-		self.singRegRead(0x04)
-		print("Reg 0x04: %02x"%self.register[0])
-		self.singRegRead(0x05)
-		print("Reg 0x05: %02x"%self.register[0])
-		self.singRegRead(0x06)
-		print("Reg 0x06: %02x"%self.register[0])
-		self.singRegRead(0x07)
-		print("Reg 0x07: %02x"%self.register[0])
-		self.singRegRead(0x08)
-		print("Reg 0x08: %02x"%self.register[0])
+		regs = self.readRegisters()
+		for regAdd in range(NUM_REGISTERS):
+			print("Reg 0x%02x: %02x"%(regAdd, regs[regAdd]))
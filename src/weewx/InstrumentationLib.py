@@ -0,0 +1,236 @@
+import bisect
+import contextlib
+import json
+import os
+import syslog
+import threading
+import time
+
+
+#
+# A latency histogram with fixed bucket boundaries (in seconds).  counts[i] is the number of observations no larger than
+# BUCKETS[i] and the final count holds everything slower than the largest bucket.
+#
+class LatencyHistogram(object):
+	BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+	def __init__(self):
+		self.counts = [0] * (len(self.BUCKETS) + 1)
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+		self.last = None
+
+	def add(self, seconds):
+		self.counts[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+		self.count += 1
+		self.total += seconds
+		self.last = seconds
+		if seconds > self.max:
+			self.max = seconds
+
+	def as_dict(self):
+		return {
+			'count': self.count,
+			'mean': self.total / self.count if self.count else None,
+			'max': self.max,
+			'last': self.last,
+			'buckets': dict(zip([str(b) for b in self.BUCKETS] + ['inf'], self.counts))
+		}
+
+
+#
+# Success and failure counts plus a latency histogram per phase (connect, read, decode, archive...) for one device of
+# one service, along with any device specific counters
+#
+class DeviceStats(object):
+	def __init__(self):
+		self.successes = 0
+		self.failures = 0
+		self.last_error = None
+		self.last_success = None
+		self.last_failure = None
+		self.phases = {}
+		self.counters = {}
+
+	def as_dict(self):
+		return {
+			'successes': self.successes,
+			'failures': self.failures,
+			'last_error': self.last_error,
+			'last_success': self.last_success,
+			'last_failure': self.last_failure,
+			'phases': dict((phase, histogram.as_dict()) for phase, histogram in self.phases.items()),
+			'counters': dict(self.counters)
+		}
+
+
+#
+# The instrumentation shared by all of the data services.  Services record how long each phase of talking to a device
+# took and whether it worked, and the whole set is periodically written out as JSON to a stats file, so we can tell
+# which device is holding up the archive records without digging through syslog.
+#
+class ServiceStats(object):
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._devices = {}
+		self._writer = None
+
+	def record(self, service, device, phase, seconds):
+		with self._lock:
+			stats = self._device(service, device)
+			histogram = stats.phases.get(phase)
+			if histogram is None:
+				histogram = stats.phases[phase] = LatencyHistogram()
+			histogram.add(seconds)
+
+	def success(self, service, device):
+		with self._lock:
+			stats = self._device(service, device)
+			stats.successes += 1
+			stats.last_success = time.time()
+
+	def failure(self, service, device, error):
+		with self._lock:
+			stats = self._device(service, device)
+			stats.failures += 1
+			stats.last_failure = time.time()
+			stats.last_error = str(error)
+
+	def counter(self, service, device, name, value):
+		with self._lock:
+			self._device(service, device).counters[name] = value
+
+	#
+	# timed()
+	#   Context manager recording how long the enclosed block took as the given phase
+	#
+	@contextlib.contextmanager
+	def timed(self, service, device, phase):
+		start = time.time()
+		try:
+			yield
+		finally:
+			self.record(service, device, phase, time.time() - start)
+
+	def snapshot(self):
+		with self._lock:
+			services = {}
+			for (service, device), stats in self._devices.items():
+				services.setdefault(service, {})[device] = stats.as_dict()
+		return {'updated': time.time(), 'services': services}
+
+	#
+	# write()
+	#   Write the current statistics to the given file, replacing it atomically so readers never see a partial file
+	#
+	def write(self, path):
+		tmp_path = path + '.tmp'
+		with open(tmp_path, 'w') as f:
+			json.dump(self.snapshot(), f, indent=1)
+		os.replace(tmp_path, path)
+
+	def start_writer(self, path, interval):
+		if self._writer is not None:
+			return
+		self._writer = threading.Thread(target=self._write_periodically, args=(path, interval), name='ServiceStats')
+		self._writer.daemon = True
+		self._writer.start()
+
+	def _write_periodically(self, path, interval):
+		while True:
+			time.sleep(interval)
+			try:
+				self.write(path)
+			except Exception:
+				pass
+
+	def _device(self, service, device):
+		stats = self._devices.get((service, device))
+		if stats is None:
+			stats = self._devices[(service, device)] = DeviceStats()
+		return stats
+
+
+_stats = ServiceStats()
+
+
+#
+# get_stats()
+#   The statistics shared by all of the data services in this weewx process.  If the optional [DataServices] section
+# of the weewx config names a stats_file, the statistics are written there every stats_interval seconds.
+#
+def get_stats(config_dict):
+	services_config = config_dict.get('DataServices', {})
+	if 'stats_file' in services_config:
+		_stats.start_writer(services_config['stats_file'], float(services_config.get('stats_interval', 60)))
+	return _stats
+
+
+LOG_LEVELS = {
+	'error': syslog.LOG_ERR,
+	'warning': syslog.LOG_WARNING,
+	'info': syslog.LOG_INFO,
+	'debug': syslog.LOG_DEBUG
+}
+
+
+#
+# Level gated syslog logging for the data services.  Messages take their arguments separately and are only formatted
+# once the level check has passed, and record() writes a whole poll's worth of values as a single structured line, so
+# nothing is built on the hot path unless it is actually going to be logged.
+#
+class ServiceLog(object):
+	def __init__(self, level=syslog.LOG_INFO):
+		self.set_level(level)
+
+	def set_level(self, level):
+		self.level = level
+		self.debug_enabled = level >= syslog.LOG_DEBUG
+
+	def log(self, priority, message, *args):
+		if priority <= self.level:
+			syslog.syslog(priority, message % args if args else message)
+
+	def debug(self, message, *args):
+		if self.debug_enabled:
+			self.log(syslog.LOG_DEBUG, message, *args)
+
+	def info(self, message, *args):
+		self.log(syslog.LOG_INFO, message, *args)
+
+	def error(self, message, *args):
+		self.log(syslog.LOG_ERR, message, *args)
+
+	#
+	# record()
+	#   Log the values of one poll of a device at debug level as a single line of name=value pairs
+	#
+	def record(self, source, values):
+		if not self.debug_enabled:
+			return
+		fields = []
+		for name in sorted(values):
+			value = values[name]
+			fields.append(('%s=%.2f' if isinstance(value, float) else '%s=%s') % (name, value))
+		syslog.syslog(syslog.LOG_DEBUG, source + ': ' + ' '.join(fields))
+
+
+_log = ServiceLog()
+
+
+#
+# get_log()
+#   The log shared by all of the data services in this weewx process.  The level comes from log_level in the optional
+# [DataServices] section of the weewx config, falling back to debug when weewx's own debug option is on.  The level is
+# re-read every time a service starts, so reloading weewx picks up a change without restarting the process.
+#
+def get_log(config_dict):
+	services_config = config_dict.get('DataServices', {})
+	if 'log_level' in services_config:
+		_log.set_level(LOG_LEVELS.get(services_config['log_level'].lower(), syslog.LOG_INFO))
+	elif int(config_dict.get('debug', 0)) > 0:
+		_log.set_level(syslog.LOG_DEBUG)
+	else:
+		_log.set_level(syslog.LOG_INFO)
+	return _log
@@ -0,0 +1,230 @@
+import array
+import operator
+import statistics
+import threading
+
+
+#
+# A fixed capacity ring buffer of samples stored column wise in compact typed arrays.  Each column is declared with a
+# name and an array typecode ('d' for doubles, 'q' for 64 bit integers and so on).  Appending a sample is O(1) and,
+# once the buffer is full, overwrites the oldest sample.
+#
+class RingBuffer(object):
+	def __init__(self, capacity, columns):
+		self.capacity = capacity
+		self.columns = [name for name, typecode in columns]
+		self._data = dict((name, array.array(typecode, [0]) * capacity) for name, typecode in columns)
+		self._lock = threading.Lock()
+		self._next = 0
+		self._count = 0
+
+	def __len__(self):
+		return self._count
+
+	def append(self, *values):
+		with self._lock:
+			for name, value in zip(self.columns, values):
+				self._data[name][self._next] = value
+			self._next = (self._next + 1) % self.capacity
+			self._count = min(self._count + 1, self.capacity)
+
+	#
+	# extend()
+	#   Append many samples at once, given as a dictionary of column name to sequence of values, oldest first.  Only
+	# the newest capacity samples are kept.
+	#
+	def extend(self, columns):
+		with self._lock:
+			count = 0
+			for name in self.columns:
+				column = self._data[name]
+				merged = self._ordered(name) + array.array(column.typecode, columns[name])
+				merged = merged[-self.capacity:]
+				column[:len(merged)] = merged
+				count = len(merged)
+			self._count = count
+			self._next = count % self.capacity
+
+	#
+	# ordered()
+	#   A contiguous copy of the named column in oldest to newest order
+	#
+	def ordered(self, name):
+		with self._lock:
+			return self._ordered(name)
+
+	#
+	# ordered_columns()
+	#   Contiguous copies of the named columns (all of them by default) in oldest to newest order, taken as one atomic
+	# step so that every column covers the same samples
+	#
+	def ordered_columns(self, names=None):
+		with self._lock:
+			return dict((name, self._ordered(name)) for name in (names or self.columns))
+
+	#
+	# drain()
+	#   Return every column in oldest to newest order and empty the buffer, as one atomic step
+	#
+	def drain(self):
+		with self._lock:
+			columns = dict((name, self._ordered(name)) for name in self.columns)
+			self._next = 0
+			self._count = 0
+		return columns
+
+	def _ordered(self, name):
+		column = self._data[name]
+		if self._count < self.capacity:
+			return column[:self._count]
+		return column[self._next:] + column[:self._next]
+
+
+#
+# summarize()
+#   The mean, minimum, maximum and time integral (in value hours) of a series of samples taken at the given epoch
+# times.  The integral uses the trapezoidal rule over the actual sample times.  previous is an optional (time, value)
+# sample from before the series, so that the gap between two consecutive series is not lost from the integral.  Gaps
+# between samples longer than max_gap seconds (the source stopped reporting) are not integrated across, like
+# RunningIntegral.
+#
+def summarize(times, values, previous=None, max_gap=None):
+	if len(values) == 0:
+		return None
+	if previous is not None and (max_gap is None or times[0] - previous[0] <= max_gap):
+		times = array.array('d', [previous[0]]) + times
+		integrated = array.array('d', [previous[1]]) + values
+	else:
+		integrated = values
+	widths = map(operator.sub, times[1:], times[:-1])
+	if max_gap is not None:
+		widths = [width if width <= max_gap else 0.0 for width in widths]
+	heights = map(operator.add, integrated[1:], integrated[:-1])
+	return {
+		'mean': sum(values) / len(values),
+		'min': min(values),
+		'max': max(values),
+		'hours': sum(map(operator.mul, widths, heights)) / 7200.0
+	}
+
+
+#
+# The running time integral (in value hours) of a stream of samples, using the trapezoidal rule over the actual sample
+# times like summarize() does for a whole series.  A sample taken no later than the previous one adds nothing, so
+# seeing the same reading twice is harmless, and gaps longer than max_gap seconds (the source stopped reporting) are
+# not integrated across.
+#
+class RunningIntegral(object):
+	def __init__(self, max_gap=None):
+		self.max_gap = max_gap
+		self.previous = None
+
+	#
+	# add()
+	#   Add a sample, returning the integral since the previous one
+	#
+	def add(self, timestamp, value):
+		increment = 0.0
+		if self.previous is not None:
+			width = timestamp - self.previous[0]
+			if width <= 0:
+				return increment
+			if self.max_gap is None or width <= self.max_gap:
+				increment = (value + self.previous[1]) * width / 7200.0
+		self.previous = (timestamp, value)
+		return increment
+
+
+#
+# downsample()
+#   The indices of at most threshold samples that best preserve the visual shape of a series, using the Largest
+# Triangle Three Buckets algorithm.  The first and last samples are always kept, and from each bucket of samples in
+# between the one forming the largest triangle with the previously kept sample and the average of the next bucket is
+# kept, so peaks and troughs survive where plain decimation would drop them.
+#
+def downsample(times, values, threshold):
+	count = len(values)
+	if threshold >= count or threshold < 3:
+		return list(range(count))
+	every = (count - 2) / float(threshold - 2)
+	indices = [0]
+	kept = 0
+	for bucket in range(threshold - 2):
+		# The average of the next bucket is the third point of the triangle
+		next_start = int((bucket + 1) * every) + 1
+		next_end = min(int((bucket + 2) * every) + 1, count)
+		next_count = next_end - next_start
+		average_time = sum(times[next_start:next_end]) / next_count
+		average_value = sum(values[next_start:next_end]) / next_count
+		kept_time = times[kept]
+		kept_value = values[kept]
+		largest = -1.0
+		for i in range(int(bucket * every) + 1, next_start):
+			area = abs((kept_time - average_time) * (values[i] - kept_value) -
+					   (kept_time - times[i]) * (average_value - kept_value))
+			if area > largest:
+				largest = area
+				chosen = i
+		indices.append(chosen)
+		kept = chosen
+	indices.append(count - 1)
+	return indices
+
+
+#
+# Running statistics over a stream of values.  The count, mean, minimum and maximum are updated as each value arrives,
+# and up to capacity of the values themselves are kept so that a median can be taken at the end of the interval.
+#
+class StreamingStatistics(object):
+	def __init__(self, capacity):
+		self.capacity = capacity
+		self.count = 0
+		self.total = 0.0
+		self.min = None
+		self.max = None
+		self.values = []
+
+	def add(self, value):
+		self.count += 1
+		self.total += value
+		if self.min is None or value < self.min:
+			self.min = value
+		if self.max is None or value > self.max:
+			self.max = value
+		if len(self.values) < self.capacity:
+			self.values.append(value)
+
+	@property
+	def mean(self):
+		return self.total / self.count if self.count else None
+
+	@property
+	def median(self):
+		return statistics.median(self.values) if self.values else None
+
+
+#
+# Collects StreamingStatistics for a set of fields over one interval.  Values are added from one thread (such as a GPIO
+# interrupt handler) while another thread periodically takes the completed interval with swap(), which hands back the
+# current statistics and starts a fresh interval in constant time.
+#
+class IntervalStatistics(object):
+	def __init__(self, fields, capacity=1000):
+		self.fields = fields
+		self.capacity = capacity
+		self._lock = threading.Lock()
+		self._current = self._new_interval()
+
+	def add(self, values):
+		with self._lock:
+			for field in self.fields:
+				self._current[field].add(values[field])
+
+	def swap(self):
+		interval = self._new_interval()
+		with self._lock:
+			interval, self._current = self._current, interval
+		return interval
+
+	def _new_interval(self):
+		return dict((field, StreamingStatistics(self.capacity)) for field in self.fields)
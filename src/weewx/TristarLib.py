@@ -0,0 +1,357 @@
+import collections
+import socket
+import threading
+import time
+
+from pymodbus.client.sync import ModbusTcpClient
+
+#
+# The tristar holding register map.  Every value we pull from the controller is described by one row: the output field
+# name (also the weewx column), the holding register offset, the scale class, the power of two exponent applied on top of
+# the scale, the weewx unit group, a human readable label and the polling tier.  Scale classes are:
+#   voltage - multiplied by the voltage scaling factor held in registers 0 and 1
+#   current - multiplied by the amperage scaling factor held in registers 2 and 3
+#   power   - multiplied by both scaling factors
+#   raw     - the register value is used as is
+# The polling tier sets how often TristarPoller reads the register, see TRISTAR_TIER_PERIODS.  Adding a new field only
+# requires adding a row here.
+#
+TristarRegister = collections.namedtuple('TristarRegister', ['field', 'offset', 'scale', 'exponent', 'unit_group',
+															 'label', 'tier'])
+
+TRISTAR_REGISTERS = [
+	# Voltage Related Statistics
+	TristarRegister('battery_voltage', 24, 'voltage', -15, 'group_volt', 'Battery Voltage', 'fast'),
+	TristarRegister('battery_sense_voltage', 26, 'voltage', -15, 'group_volt', 'Battery Sense Voltage', 'fast'),
+	TristarRegister('battery_voltage_slow', 38, 'voltage', -15, 'group_volt', 'Battery Voltage (Slow)', 'medium'),
+	TristarRegister('battery_daily_minimum_voltage', 64, 'voltage', -15, 'group_volt', 'Battery Daily Minimum Voltage',
+					'slow'),
+	TristarRegister('battery_daily_maximum_voltage', 65, 'voltage', -15, 'group_volt', 'Battery Daily Maximum Voltage',
+					'slow'),
+	TristarRegister('target_regulation_voltage', 51, 'voltage', -15, 'group_volt', 'Target Regulation Voltage', 'fast'),
+	TristarRegister('array_voltage', 27, 'voltage', -15, 'group_volt', 'Array Voltage', 'fast'),
+	# Current Related Statistics
+	TristarRegister('array_charge_current', 29, 'current', -15, 'group_amp', 'Array Charge Current', 'fast'),
+	TristarRegister('battery_charge_current', 28, 'current', -15, 'group_amp', 'Battery Charge Current', 'fast'),
+	TristarRegister('battery_charge_current_slow', 39, 'current', -15, 'group_amp', 'Battery Charge Current (slow)',
+					'medium'),
+	# Wattage Related Statistics
+	TristarRegister('input_power', 59, 'power', -17, 'group_power', 'Array Input Power', 'fast'),
+	TristarRegister('output_power', 58, 'power', -17, 'group_power', 'Controller Output Power', 'fast'),
+	# Temperature Statistics
+	TristarRegister('heatsink_temperature', 35, 'raw', 0, 'group_temperature', 'Heatsink Temperature', 'medium'),
+	TristarRegister('battery_temperature', 36, 'raw', 0, 'group_temperature', 'Battery Temperature', 'medium'),
+	# Misc Statistics
+	TristarRegister('charge_state', 50, 'raw', 0, 'group_charge_state', 'Charge State', 'fast'),
+	TristarRegister('seconds_in_absorption_daily', 77, 'raw', 0, 'group_elapsed', 'Seconds in Absorption', 'slow'),
+	TristarRegister('seconds_in_float_daily', 79, 'raw', 0, 'group_elapsed', 'Seconds in Float', 'slow'),
+	TristarRegister('seconds_in_equalize_daily', 78, 'raw', 0, 'group_elapsed', 'Seconds in Equalization', 'slow'),
+]
+
+# The scaling factors live in the first four registers
+TRISTAR_SCALE_OFFSETS = [0, 1, 2, 3]
+
+# The default number of seconds between reads of each polling tier.  The fast tier is read on every poll, the medium
+# tier holds the slow moving averages and temperatures and the slow tier the daily counters.
+TRISTAR_TIER_PERIODS = collections.OrderedDict([('fast', 0), ('medium', 60), ('slow', 300)])
+
+# Wanted registers at most this many registers apart are read in one request, as reading a few unwanted registers costs
+# less than another modbus round trip
+TRISTAR_MAX_GAP = 8
+# The most holding registers the modbus protocol allows in one read
+MODBUS_MAX_READ = 125
+
+CHARGE_STATES = ["START", "NIGHT_CHECK", "DISCONNECT", "NIGHT", "FAULT", "MPPT", "ABSORPTION", "FLOAT", "EQUALIZE",
+				 "SLAVE"]
+
+# Pre-compute the fixed part of each row's multiplier once so decoding is a single pass over the table
+_DECODE_TABLE = [(r.field, r.offset, r.scale, 2.0 ** r.exponent) for r in TRISTAR_REGISTERS]
+
+
+#
+# scaling_factors()
+#   The multiplier of each scale class, from the registers at offsets 0 to 3
+#
+def scaling_factors(registers):
+	voltage_scaling_factor = float(registers[0]) + float(registers[1]) / 100
+	amperage_scaling_factor = float(registers[2]) + float(registers[3]) / 100
+	return {
+		'voltage': voltage_scaling_factor,
+		'current': amperage_scaling_factor,
+		'power': voltage_scaling_factor * amperage_scaling_factor
+	}
+
+
+#
+# decode_registers()
+#   Convert holding registers, indexed by offset, into a dictionary of output field to scaled value.  A block read from
+# offset zero carries its own scaling factors, otherwise they must be given as returned by scaling_factors().  Only the
+# fields in table (by default every field) are decoded.
+#
+def decode_registers(registers, scales=None, table=_DECODE_TABLE):
+	if scales is None:
+		scales = scaling_factors(registers)
+	values = {}
+	for field, offset, scale, multiplier in table:
+		if scale == 'raw':
+			values[field] = registers[offset]
+		else:
+			values[field] = float(registers[offset]) * scales[scale] * multiplier
+	return values
+
+
+#
+# charge_state_name()
+#   The display name of a numeric charge state
+#
+def charge_state_name(charge_state):
+	if 0 <= charge_state < len(CHARGE_STATES):
+		return CHARGE_STATES[charge_state]
+	return "UNKNOWN"
+
+
+#
+# coalesce_registers()
+#   Merge the wanted register offsets into as few (start, count) reads as possible, reading through gaps of up to
+# max_gap unwanted registers and keeping each read within max_count registers
+#
+def coalesce_registers(offsets, max_gap=TRISTAR_MAX_GAP, max_count=MODBUS_MAX_READ):
+	ranges = []
+	for offset in sorted(set(offsets)):
+		if ranges:
+			start, count = ranges[-1]
+			if offset - (start + count) <= max_gap and offset - start < max_count:
+				ranges[-1] = (start, offset - start + 1)
+				continue
+		ranges.append((offset, 1))
+	return ranges
+
+
+#
+# read_tristar()
+#   Poll the charge controller through the given TristarPoller, recording each step in stats under device.  Raises
+# IOError if the controller could not be reached.
+#
+def read_tristar(poller, stats, device='tristar'):
+	values = poller.poll()
+	if poller.last_connect_duration is not None:
+		stats.record('tristar', device, 'connect', poller.last_connect_duration)
+	if poller.last_read_duration is not None:
+		stats.record('tristar', device, 'read', poller.last_read_duration)
+	stats.counter('tristar', device, 'connects', poller.connection.connect_count)
+	stats.counter('tristar', device, 'reads', poller.read_count)
+	stats.counter('tristar', device, 'registers_read', poller.register_count)
+	if values is None:
+		stats.failure('tristar', device, poller.connection.last_error)
+		raise IOError("Failed to connect to " + device + ": " + str(poller.connection.last_error))
+	stats.record('tristar', device, 'decode', poller.last_decode_duration)
+	stats.success('tristar', device)
+	return values
+
+
+#
+# Polls the charge controller register by register tier rather than reading the whole block every time.  The fast tier
+# is read on every poll while the medium and slow tiers are only read once their period has passed, and the registers
+# due on a poll are merged into the fewest reads (see coalesce_registers()).  The scaling factors never change while
+# the controller is up, so they are only read again after the connection is re-established.  Each poll returns only
+# the fields of the tiers it read, so the time each field was last refreshed stays true wherever the polls are merged
+# over the earlier ones (a SampleCache or SnapshotPublisher).  The first poll reads every tier.
+#
+class TristarPoller(object):
+	def __init__(self, connection, tier_periods=None, max_gap=TRISTAR_MAX_GAP):
+		self.connection = connection
+		self.tier_periods = collections.OrderedDict(TRISTAR_TIER_PERIODS)
+		self.tier_periods.update(tier_periods or {})
+		self.max_gap = max_gap
+		# The decode table of each tier
+		self._tables = collections.OrderedDict(
+			(tier, [(r.field, r.offset, r.scale, 2.0 ** r.exponent) for r in TRISTAR_REGISTERS if r.tier == tier])
+			for tier in self.tier_periods)
+		# The coalesced reads for each combination of due tiers, with and without the scaling factors
+		self._reads = {}
+		self._next_due = {}
+		self._scales = None
+		# The connect_count of the connection the cached scaling factors were read over
+		self._scales_connection = None
+		# Running totals of the modbus reads issued and the registers they carried
+		self.read_count = 0
+		self.register_count = 0
+		# How long the connects, register reads and decoding of the most recent poll took, None if that step was not
+		# reached
+		self.last_connect_duration = None
+		self.last_read_duration = None
+		self.last_decode_duration = None
+
+	#
+	# poll()
+	#   Read the tiers that are due and return their fields, or None if the controller could not be reached
+	#
+	def poll(self):
+		now = time.time()
+		self.last_connect_duration = None
+		self.last_read_duration = None
+		self.last_decode_duration = None
+		due = tuple(tier for tier, period in self.tier_periods.items() if now >= self._next_due.get(tier, 0))
+		read_scales = self._scales is None or self._scales_connection != self.connection.connect_count
+		reads = self._reads.get((due, read_scales))
+		if reads is None:
+			offsets = [offset for tier in due for field, offset, scale, multiplier in self._tables[tier]]
+			if read_scales:
+				offsets += TRISTAR_SCALE_OFFSETS
+			reads = self._reads[(due, read_scales)] = coalesce_registers(offsets, self.max_gap)
+
+		registers = {}
+		for start, count in reads:
+			block = self.connection.read_holding_registers(start, count)
+			if self.connection.last_connect_duration is not None:
+				self.last_connect_duration = (self.last_connect_duration or 0) + self.connection.last_connect_duration
+			if self.connection.last_read_duration is not None:
+				self.last_read_duration = (self.last_read_duration or 0) + self.connection.last_read_duration
+			if block is None:
+				return None
+			self.read_count += 1
+			self.register_count += count
+			registers.update(zip(range(start, start + count), block))
+			if start == reads[0][0]:
+				# The scaling factors are always in the first read, so this is the connection they came over
+				scales_connection = self.connection.connect_count
+
+		decode_start = time.time()
+		if read_scales:
+			self._scales = scaling_factors(registers)
+			self._scales_connection = scales_connection
+		values = {}
+		for tier in due:
+			values.update(decode_registers(registers, self._scales, self._tables[tier]))
+			period = self.tier_periods[tier]
+			# Keep to the tier's cadence rather than drifting later by however late each poll runs
+			next_due = self._next_due.get(tier, 0) + period
+			self._next_due[tier] = next_due if next_due > now else now + period
+		self.last_decode_duration = time.time() - decode_start
+		return values
+
+
+#
+# A long lived modbus connection to the tristar charge controller.  The controller only accepts a handful of concurrent
+# modbus sessions and the cost of the TCP connect/teardown is larger than the register read itself, so we hold a single
+# socket open and reuse it for every poll.  If the socket goes bad (controller reboot, wifi drop, half open connection)
+# it is closed and re-established, backing off exponentially between failed connection attempts so we do not hammer
+# the controller while it is unavailable.
+#
+class TristarConnection(object):
+	def __init__(self, address, port=502, unit=1, timeout=3.0, min_backoff=1.0, max_backoff=60.0,
+				 idle_timeout=120.0):
+		self.address = address
+		self.port = port
+		self.unit = unit
+		self.timeout = timeout
+		self.min_backoff = min_backoff
+		self.max_backoff = max_backoff
+		self.idle_timeout = idle_timeout
+		self.last_error = None
+		self.connect_count = 0
+		# How long the connect and register read of the most recent call took, None if that step was not reached
+		self.last_connect_duration = None
+		self.last_read_duration = None
+		self._client = None
+		self._lock = threading.Lock()
+		self._backoff = 0.0
+		self._next_attempt = 0.0
+		self._last_success = 0.0
+
+	#
+	# read_holding_registers()
+	#   Read count holding registers starting at start.  Returns the list of register values, or None if the controller
+	# could not be reached.  A failed read on a connection that had been working is retried once on a fresh socket, as
+	# the most likely cause is the controller silently dropping our session.
+	#
+	def read_holding_registers(self, start, count):
+		with self._lock:
+			self.last_connect_duration = None
+			self.last_read_duration = None
+			for attempt in range(2):
+				fresh = self._client is None
+				if not self._ensure_connected():
+					return None
+				try:
+					read_start = time.time()
+					rr = self._client.read_holding_registers(start, count, unit=self.unit)
+					self.last_read_duration = time.time() - read_start
+					if rr is None or rr.isError():
+						raise IOError("modbus error response: " + str(rr))
+					self._last_success = time.time()
+					self._backoff = 0.0
+					return rr.registers
+				except Exception as e:
+					self.last_error = str(e)
+					self._drop()
+					if fresh:
+						self._schedule_retry()
+						return None
+			return None
+
+	#
+	# close()
+	#   Close the underlying socket.  The next read will reconnect.
+	#
+	def close(self):
+		with self._lock:
+			self._drop()
+
+	def _ensure_connected(self):
+		# A connection that has sat idle longer than the controller keeps sessions around is most likely half open, so
+		# throw it away rather than waiting on a read timeout to find out
+		if self._client is not None and self._last_success and time.time() - self._last_success > self.idle_timeout:
+			self._drop()
+		if self._client is not None and self._client.is_socket_open():
+			return True
+		if time.time() < self._next_attempt:
+			return False
+		self._client = ModbusTcpClient(self.address, port=self.port, timeout=self.timeout)
+		error = None
+		connect_start = time.time()
+		try:
+			connected = self._client.connect()
+		except Exception as e:
+			error = str(e)
+			connected = False
+		self.last_connect_duration = time.time() - connect_start
+		if not connected:
+			self.last_error = error or "unable to connect to %s:%d" % (self.address, self.port)
+			self._drop()
+			self._schedule_retry()
+			return False
+		self._enable_keepalive(self._client.socket)
+		self.connect_count += 1
+		self._last_success = time.time()
+		self.last_error = None
+		return True
+
+	def _schedule_retry(self):
+		self._backoff = min(self.max_backoff, max(self.min_backoff, self._backoff * 2))
+		self._next_attempt = time.time() + self._backoff
+
+	def _drop(self):
+		if self._client is not None:
+			try:
+				self._client.close()
+			except Exception:
+				pass
+		self._client = None
+
+	#
+	# Ask the kernel to probe the connection while it is idle, so that a controller that disappeared without closing
+	# the session is detected instead of leaving us with a half open socket
+	#
+	@staticmethod
+	def _enable_keepalive(sock):
+		if sock is None:
+			return
+		try:
+			sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+			if hasattr(socket, 'TCP_KEEPIDLE'):
+				sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30)
+				sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10)
+				sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+		except (OSError, AttributeError):
+			pass